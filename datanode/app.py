@@ -1,16 +1,31 @@
-from fastapi import FastAPI, UploadFile, HTTPException
-from fastapi import FastAPI, UploadFile, HTTPException
-from fastapi.responses import FileResponse, JSONResponse
-from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import FileResponse, ORJSONResponse, Response
+from starlette.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager, suppress
 import os
+import asyncio
+import aiohttp
+import re
+import stat
+import struct
 import time
+import random
 import threading
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime
 import shutil
+import tempfile
+import sys
+import queue
 import logging
 import hashlib
+import mmap
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
+from urllib.parse import quote
+from typing import List, Optional
+from pydantic import BaseModel
 
 # Configurar logging con nivel configurable
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
@@ -28,38 +43,109 @@ DATANODE_URL = os.getenv("DATANODE_URL", "http://localhost:5000")
 NAMENODE_URL = os.getenv("NAMENODE_URL", "http://namenode:5000")
 MAX_RETRIES = int(os.getenv("MAX_RETRIES", "20"))
 EXTERNAL_URL = os.getenv("EXTERNAL_URL", DATANODE_URL)
+WRITE_BUFFER_SIZE = int(os.getenv("WRITE_BUFFER_SIZE", str(8 * 1024 * 1024)))
+# Máximo de chunks por writev (por debajo de IOV_MAX, 1024 en Linux)
+MAX_WRITE_CHUNKS = 512
+# Tamaño máximo del cuerpo de /upload_blocks_batch
+MAX_BATCH_BYTES = int(os.getenv("MAX_BATCH_BYTES", str(64 * 1024 * 1024)))
+# Longitudes del formato de lote: u32 big-endian
+_BATCH_LEN = struct.Struct("!I")
+# Si hay un nginx delante, prefijo de su location interna que sirve blocks/:
+# los bloques se delegan con X-Accel-Redirect y nginx los envía con sendfile
+ACCEL_REDIRECT_PREFIX = os.getenv("ACCEL_REDIRECT_PREFIX", "").rstrip("/")
+# Cada cuánto se recalculan desde disco el número y tamaño total de bloques
+BLOCK_STATS_REFRESH = int(os.getenv("BLOCK_STATS_REFRESH", "300"))
+# Segundos durante los que se reutiliza la consulta de espacio libre
+FREE_SPACE_CACHE_SECONDS = 5.0
+# Ruta de bloques resuelta una sola vez (rutas calientes sin Path por petición)
+BLOCKS_DIR = os.path.join(STORAGE_ROOT, "blocks") + os.sep
+TEMP_DIR = os.path.join(STORAGE_ROOT, "temp")
 
-# Crear estructura de directorios
-for path in [STORAGE_ROOT, LOGS_PATH]:
-    Path(path).mkdir(parents=True, exist_ok=True)
+# Sesión HTTP compartida para el registro (síncrono) con el NameNode:
+# reutiliza la conexión keep-alive en lugar de abrir una por llamada
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=0)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+
+# Subidas de bloques en curso (se reporta en /stats para balancear carga)
+_inflight_uploads = 0
+
+# Número y bytes de bloques almacenados: se mantienen en memoria al subir y
+# borrar bloques, y se recalculan desde disco cada BLOCK_STATS_REFRESH segundos
+_block_stats_lock = threading.Lock()
+_block_count = 0
+_block_bytes = 0
+_block_stats_time = None
+
+# (instante, bytes libres) de la última consulta de espacio libre
+_free_space_cache = None
+
+# (segundo, timestamp ISO) para los campos "timestamp" de las respuestas
+_now_iso_cache = (0, "")
+
+# Sanitizado de block_id: separadores de ruta a "_" en una sola pasada
+_BLOCK_ID_TABLE = str.maketrans({"/": "_", "\\": "_"})
+# Nombres inutilizables como archivo: vacío, ".", o con caracteres de control
+_INVALID_BLOCK_ID = re.compile(r"^\.?$|[\x00-\x1f]")
+# NAME_MAX (255) menos el sufijo del archivo temporal de mkstemp
+MAX_BLOCK_ID_BYTES = 240
+
+def sanitize_block_id(block_id: str) -> str:
+    """Convertir un block_id en un nombre de archivo seguro dentro de blocks/"""
+    safe_block_id = block_id.translate(_BLOCK_ID_TABLE).replace("..", "")
+    if _INVALID_BLOCK_ID.search(safe_block_id) or len(safe_block_id.encode()) > MAX_BLOCK_ID_BYTES:
+        raise HTTPException(status_code=400, detail="Invalid block id")
+    return safe_block_id
+
+class NodeLogFormatter(logging.Formatter):
+    """Formato de los logs del DataNode: timestamp ISO, nivel y node_id"""
+    def formatTime(self, record, datefmt=None):
+        return datetime.fromtimestamp(record.created).isoformat()
+
+# Los logs del nodo se encolan y un hilo aparte los escribe a stdout y al
+# archivo (abierto una sola vez), sin bloquear los endpoints
+_log_queue = queue.Queue(-1)
+node_logger = logging.getLogger(f"griddfs.datanode.{NODE_ID}")
+node_logger.setLevel(logging.DEBUG)
+node_logger.propagate = False
+node_logger.addHandler(QueueHandler(_log_queue))
+_log_formatter = NodeLogFormatter("%(asctime)s [%(levelname)s] %(message)s")
+_stdout_handler = logging.StreamHandler(sys.stdout)
+_stdout_handler.setFormatter(_log_formatter)
+_file_handler = logging.FileHandler(Path(LOGS_PATH) / f"{NODE_ID}.log", encoding="utf-8", delay=True)
+_file_handler.setFormatter(_log_formatter)
+log_listener = QueueListener(_log_queue, _stdout_handler, _file_handler)
+log_listener.start()
+
+def now_iso() -> str:
+    """Timestamp ISO del segundo actual, formateado una sola vez por segundo"""
+    global _now_iso_cache
+    second = int(time.time())
+    if second != _now_iso_cache[0]:
+        _now_iso_cache = (second, datetime.fromtimestamp(second).isoformat())
+    return _now_iso_cache[1]
 
 def log_message(message: str, level: str = "INFO"):
     """Log messages to stdout and file with timestamp"""
-    timestamp = datetime.now().isoformat()
-    log_entry = f"{timestamp} [{level}] {NODE_ID}: {message}"
-    print(log_entry)
-    
-    # También escribir a archivo de log
-    log_file = Path(LOGS_PATH) / f"{NODE_ID}.log"
-    try:
-        with open(log_file, "a", encoding="utf-8") as f:
-            f.write(log_entry + "\n")
-    except Exception as e:
-        logger.error(f"Error escribiendo log: {e}")
+    node_logger.log(getattr(logging, level, logging.INFO), "%s: %s", NODE_ID, message)
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 30.0) -> float:
+    """Backoff exponencial con full jitter: los DataNodes que arrancan a la vez
+    no reintentan sincronizados contra el NameNode"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
 
 def register_with_namenode() -> bool:
     """Register with NameNode with improved retry logic"""
-    retry_delay = 3
-    
     for attempt in range(MAX_RETRIES):
         try:
             log_message(f"Intento {attempt + 1}/{MAX_RETRIES} de registro con NameNode...")
             
             # Verificar primero si NameNode responde
-            health_check = requests.get(f"{NAMENODE_URL}/", timeout=10)
+            health_check = SESSION.get(f"{NAMENODE_URL}/", timeout=10)
             if health_check.status_code != 200:
                 log_message(f"NameNode no responde aún (HTTP {health_check.status_code})", "WARNING")
-                time.sleep(retry_delay)
+                time.sleep(backoff_delay(attempt))
                 continue
             
             # Obtener información del sistema para el registro
@@ -72,7 +158,7 @@ def register_with_namenode() -> bool:
                 "storage_capacity": storage_capacity
             }
             
-            response = requests.post(
+            response = SESSION.post(
                 f"{NAMENODE_URL}/register_datanode",
                 json=registration_data,
                 timeout=15
@@ -92,67 +178,72 @@ def register_with_namenode() -> bool:
         except Exception as e:
             log_message(f"Error inesperado en registro (intento {attempt + 1}): {e}", "ERROR")
         
-        time.sleep(min(retry_delay * (attempt + 1), 30))  # Backoff exponencial limitado
+        time.sleep(backoff_delay(attempt))
     
     log_message("No se pudo registrar con NameNode después de todos los intentos", "ERROR")
     return False
 
-def start_heartbeat():
-    """Start heartbeat thread with improved error handling"""
-    def heartbeat_loop():
-        consecutive_failures = 0
-        max_failures = 5
-        
-        while True:
-            try:
-                heartbeat_data = {
-                    "datanode_url": DATANODE_URL,
-                    "node_id": NODE_ID,
-                    "total_blocks": count_blocks(),
-                    "storage_capacity": get_available_storage()
-                }
-                
-                response = requests.post(
-                    f"{NAMENODE_URL}/heartbeat",
-                    json=heartbeat_data,
-                    timeout=10
-                )
-                
-                if response.status_code == 200:
+async def heartbeat_loop(session: aiohttp.ClientSession):
+    """Heartbeat periódico al NameNode como tarea del event loop"""
+    consecutive_failures = 0
+    max_failures = 5
+    
+    while True:
+        try:
+            heartbeat_data = {
+                "datanode_url": DATANODE_URL,
+                "node_id": NODE_ID,
+                "total_blocks": await run_in_threadpool(count_blocks),
+                "storage_capacity": await run_in_threadpool(get_available_storage)
+            }
+            
+            async with session.post(f"{NAMENODE_URL}/heartbeat", json=heartbeat_data) as response:
+                if response.status == 200:
                     if consecutive_failures > 0:
                         log_message("Heartbeat restablecido")
                     consecutive_failures = 0
                 else:
                     consecutive_failures += 1
-                    log_message(f"Heartbeat falló (HTTP {response.status_code})", "WARNING")
-                    
-            except Exception as e:
-                consecutive_failures += 1
-                log_message(f"Error enviando heartbeat: {e}", "ERROR")
+                    log_message(f"Heartbeat falló (HTTP {response.status})", "WARNING")
                 
-                # Si hay muchos fallos consecutivos, intentar re-registro
-                if consecutive_failures >= max_failures:
-                    log_message("Demasiados fallos de heartbeat, intentando re-registro...", "WARNING")
-                    if register_with_namenode():
-                        consecutive_failures = 0
+        except Exception as e:
+            consecutive_failures += 1
+            log_message(f"Error enviando heartbeat: {e}", "ERROR")
             
-            time.sleep(30)
-    
-    heartbeat_thread = threading.Thread(target=heartbeat_loop, daemon=True)
-    heartbeat_thread.start()
-    log_message("Heartbeat iniciado")
+            # Si hay muchos fallos consecutivos, intentar re-registro
+            if consecutive_failures >= max_failures:
+                log_message("Demasiados fallos de heartbeat, intentando re-registro...", "WARNING")
+                if await run_in_threadpool(register_with_namenode):
+                    consecutive_failures = 0
+        
+        # Intervalo normal de 30s; tras un fallo, reintentar con backoff
+        await asyncio.sleep(backoff_delay(consecutive_failures) if consecutive_failures else 30)
 
 def get_available_storage() -> int:
     """Get available storage space in bytes"""
+    global _free_space_cache
+    # El espacio libre apenas cambia entre health checks: se cachea unos segundos
+    now = time.monotonic()
+    if _free_space_cache is not None and now - _free_space_cache[0] < FREE_SPACE_CACHE_SECONDS:
+        return _free_space_cache[1]
     try:
-        return shutil.disk_usage(STORAGE_ROOT).free
+        if hasattr(os, "statvfs"):
+            usage = os.statvfs(STORAGE_ROOT)
+            free = usage.f_bavail * usage.f_frsize
+        else:
+            free = shutil.disk_usage(STORAGE_ROOT).free
     except Exception:
-        return 0
+        free = 0
+    # Asignar la tupla completa es atómico: no hace falta lock
+    _free_space_cache = (now, free)
+    return free
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Lifespan context manager para startup/shutdown"""
     # ==================== STARTUP ====================
+    # El archivo de log vive en LOGS_PATH: crearlo antes del primer log
+    Path(LOGS_PATH).mkdir(parents=True, exist_ok=True)
     log_message(f"Iniciando DataNode: {NODE_ID}")
     log_message(f"Storage root: {STORAGE_ROOT}")
     log_message(f"Conectando a NameNode: {NAMENODE_URL}")
@@ -164,10 +255,17 @@ async def lifespan(app: FastAPI):
         dir_path = Path(STORAGE_ROOT) / directory
         dir_path.mkdir(parents=True, exist_ok=True)
         log_message(f"Directorio creado: {dir_path}")
+    scan_blocks()
+    
+    # Sesión async compartida (keep-alive) para heartbeats y consultas de
+    # estado al NameNode
+    app.state.http = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
     
     # Intentar registro con NameNode
+    app.state.heartbeat_task = None
     if register_with_namenode():
-        start_heartbeat()
+        app.state.heartbeat_task = asyncio.create_task(heartbeat_loop(app.state.http))
+        log_message("Heartbeat iniciado")
         log_message("DataNode inicializado y registrado exitosamente")
     else:
         log_message("DataNode funcionando en modo desconectado (sin NameNode)", "WARNING")
@@ -176,84 +274,143 @@ async def lifespan(app: FastAPI):
     
     # ==================== SHUTDOWN ====================
     log_message("DataNode shutting down...")
+    if app.state.heartbeat_task is not None:
+        app.state.heartbeat_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await app.state.heartbeat_task
+    await app.state.http.close()
+    log_listener.stop()
 
 # Crear la app con lifespan
 app = FastAPI(
     title=f"GridDFS DataNode - {NODE_ID}",
     description="DataNode del sistema de archivos distribuido GridDFS",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
+class BlockFileResponse(FileResponse):
+    """FileResponse para bloques con lecturas de 1MB en lugar de los 64KB por
+    defecto de Starlette (sin nginx delante, ver ACCEL_REDIRECT_PREFIX)"""
+    chunk_size = 1024 * 1024
+
+class BlockQuery(BaseModel):
+    block_ids: List[str]
+
 # ==================== REST API ENDPOINTS ====================
 @app.get("/")
-def health():
+async def health():
     """Health check endpoint"""
     return {
         "node_id": NODE_ID,
         "storage_root": STORAGE_ROOT,
-        "total_blocks": count_blocks(),
+        "total_blocks": await run_in_threadpool(count_blocks),
         "total_size": get_storage_size(),
         "free_space": get_available_storage(),
         "status": "healthy",
-        "registered": is_registered_with_namenode(),
-        "timestamp": datetime.now().isoformat()
+        "registered": await is_registered_with_namenode(),
+        "timestamp": now_iso()
     }
 
-def is_registered_with_namenode() -> bool:
+async def is_registered_with_namenode() -> bool:
     """Check if this datanode is registered with namenode"""
     try:
-        response = requests.get(f"{NAMENODE_URL}/", timeout=5)
-        if response.status_code == 200:
-            data = response.json()
-            active_nodes = data.get("datanodes", [])
-            return any(node.get("url") == DATANODE_URL for node in active_nodes)
+        # Misma sesión keep-alive que los heartbeats
+        async with app.state.http.get(f"{NAMENODE_URL}/", timeout=aiohttp.ClientTimeout(total=5)) as response:
+            if response.status == 200:
+                data = await response.json()
+                active_nodes = data.get("datanodes", [])
+                return any(node.get("url") == DATANODE_URL for node in active_nodes)
     except Exception:
         pass
     return False
 
+def scan_blocks():
+    """Recalcular desde disco el número y tamaño total de bloques (un solo scandir)"""
+    global _block_count, _block_bytes, _block_stats_time
+    count = 0
+    total_size = 0
+    try:
+        with os.scandir(BLOCKS_DIR) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file(follow_symlinks=False):
+                        total_size += entry.stat(follow_symlinks=False).st_size
+                        count += 1
+                except OSError:
+                    continue
+    except FileNotFoundError:
+        pass
+    with _block_stats_lock:
+        _block_count = count
+        _block_bytes = total_size
+        _block_stats_time = time.monotonic()
+
+def update_block_stats(count_delta: int, bytes_delta: int):
+    """Actualizar los contadores de bloques tras subir o borrar un bloque"""
+    global _block_count, _block_bytes
+    with _block_stats_lock:
+        _block_count += count_delta
+        _block_bytes += bytes_delta
+
+def refresh_block_stats():
+    """Recalcular los contadores si aún no se han calculado o están viejos"""
+    if _block_stats_time is None or time.monotonic() - _block_stats_time > BLOCK_STATS_REFRESH:
+        scan_blocks()
+
 def count_blocks() -> int:
     """Count number of blocks stored"""
-    blocks_dir = Path(STORAGE_ROOT) / "blocks"
-    if blocks_dir.exists():
-        return len([f for f in blocks_dir.iterdir() if f.is_file()])
-    return 0
+    refresh_block_stats()
+    return _block_count
 
 def get_storage_size() -> int:
     """Get total storage size in bytes"""
-    total_size = 0
-    blocks_dir = Path(STORAGE_ROOT) / "blocks"
-    if blocks_dir.exists():
-        for file_path in blocks_dir.iterdir():
-            if file_path.is_file():
-                try:
-                    total_size += file_path.stat().st_size
-                except Exception:
-                    continue
-    return total_size
+    refresh_block_stats()
+    return _block_bytes
 
 @app.post("/upload_block/{block_id}")
-async def upload_block(block_id: str, file: UploadFile):
-    """Upload a block to this DataNode"""
+async def upload_block(block_id: str, request: Request):
+    """Upload a block to this DataNode (raw application/octet-stream body)"""
     # Sanitizar el block_id
-    safe_block_id = block_id.replace("/", "_").replace("..", "").replace("\\", "_")
+    safe_block_id = sanitize_block_id(block_id)
     block_path = Path(STORAGE_ROOT) / "blocks" / safe_block_id
     
+    global _inflight_uploads
+    _inflight_uploads += 1
+    temp_path = None
     try:
-        # Asegurar que el directorio padre existe
-        block_path.parent.mkdir(parents=True, exist_ok=True)
-        
-        # Escribir el archivo por chunks para manejar archivos grandes
-        with open(block_path, "wb") as f:
-            while True:
-                chunk = await file.read(1024 * 1024)  # 1MB chunks
-                if not chunk:
-                    break
-                f.write(chunk)
+        # Escribir el cuerpo a medida que llega del socket, sin multipart.
+        # Los chunks se agrupan hasta WRITE_BUFFER_SIZE y se escriben con un
+        # solo writev en el threadpool, sin bloquear el event loop.
+        # Se escribe en temp/ y se renombra al final: un bloque presente en
+        # blocks/ siempre está completo
+        fd, temp_path = await run_in_threadpool(tempfile.mkstemp, ".part", safe_block_id + ".", TEMP_DIR)
+        # El hash se calcula con los mismos chunks que se escriben, sin
+        # releer el bloque desde disco
+        hasher = hashlib.sha256()
+        file_size = 0
+        try:
+            pending = []
+            pending_size = 0
+            async for chunk in request.stream():
+                pending.append(chunk)
+                pending_size += len(chunk)
+                if pending_size >= WRITE_BUFFER_SIZE or len(pending) >= MAX_WRITE_CHUNKS:
+                    await run_in_threadpool(write_chunks, fd, pending, hasher)
+                    file_size += pending_size
+                    pending = []
+                    pending_size = 0
+            if pending:
+                await run_in_threadpool(write_chunks, fd, pending, hasher)
+                file_size += pending_size
+        finally:
+            await run_in_threadpool(os.close, fd)
+        # chmod, stat y rename tocan disco: fuera del event loop
+        await run_in_threadpool(commit_block, temp_path, str(block_path), file_size)
+        temp_path = None
         
-        # Calcular hash para verificación
-        file_hash = calculate_block_hash(str(block_path))
-        file_size = block_path.stat().st_size
+        file_hash = hasher.hexdigest()
         
         log_message(f"Bloque almacenado: {safe_block_id} ({file_size} bytes, hash: {file_hash[:8]}...)")
         
@@ -263,70 +420,213 @@ async def upload_block(block_id: str, file: UploadFile):
             "hash": file_hash,
             "datanode": DATANODE_URL,
             "storage_path": str(block_path),
-            "timestamp": datetime.now().isoformat()
+            "timestamp": now_iso()
         }
         
     except Exception as e:
         log_message(f"Error subiendo bloque {block_id}: {e}", "ERROR")
         # Limpiar archivo parcial si existe
-        if block_path.exists():
+        if temp_path and os.path.exists(temp_path):
             try:
-                block_path.unlink()
+                os.unlink(temp_path)
             except Exception:
                 pass
         raise HTTPException(status_code=500, detail=f"Error storing block: {e}")
+    finally:
+        _inflight_uploads -= 1
+
+def commit_block(temp_path: str, block_path: str, file_size: int):
+    """Mover un bloque ya escrito en temp/ a blocks/ y actualizar estadísticas"""
+    os.chmod(temp_path, 0o644)
+    try:
+        replaced_size = os.stat(block_path).st_size
+    except FileNotFoundError:
+        replaced_size = None
+    os.replace(temp_path, block_path)
+    if replaced_size is None:
+        update_block_stats(1, file_size)
+    else:
+        update_block_stats(0, file_size - replaced_size)
+
+def parse_block_batch(body: bytes) -> List[tuple]:
+    """Separar un lote en (block_id saneado, datos).
+    Formato: repetido u32 len(id) | id utf-8 | u32 len(datos) | datos"""
+    view = memoryview(body)
+    items = []
+    offset = 0
+    while offset < len(view):
+        fields = []
+        for _ in range(2):
+            if offset + _BATCH_LEN.size > len(view):
+                raise HTTPException(status_code=400, detail="Truncated batch")
+            (length,) = _BATCH_LEN.unpack_from(view, offset)
+            offset += _BATCH_LEN.size
+            if offset + length > len(view):
+                raise HTTPException(status_code=400, detail="Truncated batch")
+            fields.append(view[offset:offset + length])
+            offset += length
+        raw_id, data = fields
+        try:
+            block_id = bytes(raw_id).decode("utf-8")
+        except UnicodeDecodeError:
+            raise HTTPException(status_code=400, detail="Invalid block id")
+        items.append((sanitize_block_id(block_id), data))
+    return items
+
+def store_block_batch(items: List[tuple]) -> List[dict]:
+    """Escribir los bloques de un lote (se ejecuta en el threadpool)"""
+    stored = []
+    for safe_block_id, data in items:
+        fd, temp_path = tempfile.mkstemp(".part", safe_block_id + ".", TEMP_DIR)
+        try:
+            try:
+                hasher = hashlib.sha256()
+                write_chunks(fd, [data], hasher)
+            finally:
+                os.close(fd)
+            commit_block(temp_path, BLOCKS_DIR + safe_block_id, len(data))
+        except BaseException:
+            with suppress(FileNotFoundError):
+                os.unlink(temp_path)
+            raise
+        stored.append({"block_id": safe_block_id, "size": len(data), "hash": hasher.hexdigest()})
+    return stored
+
+@app.post("/upload_blocks_batch")
+async def upload_blocks_batch(request: Request):
+    """Subir varios bloques en una sola petición (cuerpo en formato de lote)"""
+    content_length = request.headers.get("content-length")
+    if content_length is not None:
+        try:
+            declared_size = int(content_length)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid Content-Length")
+        if declared_size > MAX_BATCH_BYTES:
+            raise HTTPException(status_code=413, detail="Batch too large")
+    
+    global _inflight_uploads
+    _inflight_uploads += 1
+    try:
+        # Los lotes son de bloques pequeños: se leen enteros y se validan
+        # antes de escribir ninguno
+        body = await request.body()
+        if len(body) > MAX_BATCH_BYTES:
+            raise HTTPException(status_code=413, detail="Batch too large")
+        items = parse_block_batch(body)
+        try:
+            stored = await run_in_threadpool(store_block_batch, items)
+        except HTTPException:
+            raise
+        except Exception as e:
+            log_message(f"Error subiendo lote de {len(items)} bloques: {e}", "ERROR")
+            raise HTTPException(status_code=500, detail=f"Error storing batch: {e}")
+        
+        log_message(f"Lote almacenado: {len(stored)} bloques ({len(body)} bytes)")
+        return {
+            "blocks": stored,
+            "datanode": DATANODE_URL,
+            "timestamp": now_iso()
+        }
+    finally:
+        _inflight_uploads -= 1
 
 @app.get("/block/{block_id}")
 def get_block(block_id: str):
     """Retrieve a block from this DataNode"""
-    safe_block_id = block_id.replace("/", "_").replace("..", "").replace("\\", "_")
-    block_path = Path(STORAGE_ROOT) / "blocks" / safe_block_id
+    safe_block_id = sanitize_block_id(block_id)
+    block_path = BLOCKS_DIR + safe_block_id
     
-    if not block_path.exists():
+    # Un único stat: sin comprobación previa de existencia (evita TOCTOU)
+    try:
+        block_stat = os.stat(block_path)
+    except FileNotFoundError:
         log_message(f"Bloque no encontrado: {safe_block_id}", "WARNING")
         raise HTTPException(status_code=404, detail="Block not found")
     
-    if not block_path.is_file():
+    if not stat.S_ISREG(block_stat.st_mode):
         log_message(f"Ruta no es un archivo: {safe_block_id}", "ERROR")
         raise HTTPException(status_code=404, detail="Block not found")
     
     log_message(f"Enviando bloque: {safe_block_id}")
-    return FileResponse(
-        str(block_path), 
+    if ACCEL_REDIRECT_PREFIX:
+        return Response(
+            media_type="application/octet-stream",
+            headers={"X-Accel-Redirect": f"{ACCEL_REDIRECT_PREFIX}/{quote(safe_block_id)}"}
+        )
+    return BlockFileResponse(
+        block_path, 
         media_type="application/octet-stream",
-        filename=safe_block_id
+        filename=safe_block_id,
+        stat_result=block_stat
     )
 
-@app.get("/storage_info")
-def get_storage_info():
-    """Get detailed storage information"""
-    blocks_dir = Path(STORAGE_ROOT) / "blocks"
+@app.get("/stats")
+def stats():
+    """Carga actual del DataNode, usada por el cliente para repartir bloques"""
+    return {
+        "node_id": NODE_ID,
+        "inflight": _inflight_uploads,
+        "free_bytes": get_available_storage(),
+        "total_blocks": count_blocks()
+    }
+
+@app.post("/exists_batch")
+def exists_batch(query: BlockQuery):
+    """Indicar cuáles de los bloques consultados ya están almacenados y su tamaño"""
+    blocks = {}
+    for block_id in query.block_ids:
+        try:
+            blocks[block_id] = os.stat(BLOCKS_DIR + sanitize_block_id(block_id)).st_size
+        except (OSError, HTTPException):
+            continue
+    return {"blocks": blocks}
+
+def list_blocks(limit: Optional[int] = None):
+    """Listar los bloques almacenados con sus totales (limit acota el detalle)"""
     blocks = []
+    total_blocks = 0
+    total_size = 0
     
-    if blocks_dir.exists():
-        for block_file in blocks_dir.iterdir():
-            if block_file.is_file():
+    # Una sola pasada: los totales cuentan todos los bloques, pero solo se
+    # construye el detalle de los primeros `limit`
+    try:
+        with os.scandir(BLOCKS_DIR) as entries:
+            for entry in entries:
                 try:
-                    stat = block_file.stat()
-                    blocks.append({
-                        "block_id": block_file.name,
-                        "size": stat.st_size,
-                        "created": datetime.fromtimestamp(stat.st_ctime).isoformat(),
-                        "modified": datetime.fromtimestamp(stat.st_mtime).isoformat()
-                    })
-                except Exception:
+                    if entry.is_file(follow_symlinks=False):
+                        block_stat = entry.stat(follow_symlinks=False)
+                        total_blocks += 1
+                        total_size += block_stat.st_size
+                        if limit is None or len(blocks) < limit:
+                            blocks.append({
+                                "block_id": entry.name,
+                                "size": block_stat.st_size,
+                                "created": datetime.fromtimestamp(block_stat.st_ctime).isoformat(),
+                                "modified": datetime.fromtimestamp(block_stat.st_mtime).isoformat()
+                            })
+                except OSError:
                     continue
+    except FileNotFoundError:
+        pass
+    return blocks, total_blocks, total_size
+
+@app.get("/storage_info")
+async def get_storage_info(limit: Optional[int] = None):
+    """Get detailed storage information (limit acota los bloques listados)"""
+    blocks, total_blocks, total_size = await run_in_threadpool(list_blocks, limit)
     
-    return {
+    # Devolver la respuesta directamente evita el paso de jsonable_encoder
+    # sobre la lista de bloques
+    return ORJSONResponse({
         "node_id": NODE_ID,
         "storage_root": STORAGE_ROOT,
-        "total_blocks": len(blocks),
-        "total_size": sum(block["size"] for block in blocks),
+        "total_blocks": total_blocks,
+        "total_size": total_size,
         "blocks": blocks,
         "free_space": get_available_storage(),
-        "registered": is_registered_with_namenode(),
-        "timestamp": datetime.now().isoformat()
-    }
+        "registered": await is_registered_with_namenode(),
+        "timestamp": now_iso()
+    })
 
 @app.post("/reregister")
 def reregister():
@@ -338,21 +638,40 @@ def reregister():
         log_message("Re-registro completado exitosamente")
     return {"success": success, "message": "Re-registration attempted"}
 
+def write_chunks(fd: int, chunks: List[bytes], hasher=None):
+    """Escribir varios chunks con una sola syscall writev, sin concatenarlos
+    (y actualizar el hash del bloque con los mismos chunks)"""
+    if hasher is not None:
+        for chunk in chunks:
+            hasher.update(chunk)
+    remaining = sum(len(chunk) for chunk in chunks) - os.writev(fd, chunks)
+    if remaining:
+        # Escritura parcial (poco frecuente): completar con write
+        tail = memoryview(b"".join(chunks))[-remaining:]
+        while tail:
+            tail = tail[os.write(fd, tail):]
+
 def calculate_block_hash(file_path: str) -> str:
-    """Calcular hash MD5 de un bloque para verificación de integridad"""
-    hash_md5 = hashlib.md5()
+    """Calcular hash SHA-256 de un bloque para verificación de integridad"""
+    hash_sha256 = hashlib.sha256()
     try:
         with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+            # mmap no admite archivos vacíos
+            if os.fstat(f.fileno()).st_size == 0:
+                return hash_sha256.hexdigest()
+            # Un solo update sobre el archivo mapeado: sin bytes intermedios
+            # por chunk, y hashlib libera el GIL mientras calcula
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                with memoryview(mapped) as view:
+                    hash_sha256.update(view)
+        return hash_sha256.hexdigest()
     except Exception:
         return "error"
 
 @app.get("/block_info/{block_id}")
 def get_block_info(block_id: str):
     """Obtener información detallada de un bloque"""
-    safe_block_id = block_id.replace("/", "_").replace("..", "").replace("\\", "_")
+    safe_block_id = sanitize_block_id(block_id)
     block_path = Path(STORAGE_ROOT) / "blocks" / safe_block_id
     
     if not block_path.exists():
@@ -374,21 +693,24 @@ def get_block_info(block_id: str):
 @app.delete("/block/{block_id}")
 def delete_block(block_id: str):
     """Eliminar un bloque (para operaciones de mantenimiento)"""
-    safe_block_id = block_id.replace("/", "_").replace("..", "").replace("\\", "_")
-    block_path = Path(STORAGE_ROOT) / "blocks" / safe_block_id
-    
-    if not block_path.exists():
-        raise HTTPException(status_code=404, detail="Block not found")
+    safe_block_id = sanitize_block_id(block_id)
+    block_path = BLOCKS_DIR + safe_block_id
     
     try:
-        block_path.unlink()
-        log_message(f"Bloque eliminado: {safe_block_id}")
-        
-        return {
-            "status": "deleted", 
-            "block_id": safe_block_id,
-            "timestamp": datetime.now().isoformat()
-        }
+        # stat + unlink directos: sin comprobación previa de existencia (TOCTOU)
+        block_size = os.stat(block_path).st_size
+        os.unlink(block_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Block not found")
     except Exception as e:
         log_message(f"Error eliminando bloque {safe_block_id}: {e}", "ERROR")
-        raise HTTPException(status_code=500, detail=f"Error deleting block: {e}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Error deleting block: {e}")
+    
+    update_block_stats(-1, -block_size)
+    log_message(f"Bloque eliminado: {safe_block_id}")
+    
+    return {
+        "status": "deleted", 
+        "block_id": safe_block_id,
+        "timestamp": now_iso()
+    }
\ No newline at end of file
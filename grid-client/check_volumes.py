@@ -4,34 +4,52 @@ Verificación de estructura de volúmenes
 """
 import requests
 import os
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from config import NAMENODE_URL
 
+# Una sola sesión para el NameNode y todos los DataNodes (conexiones keep-alive)
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_maxsize=8))
+
+def _safe_get(url):
+    """GET que devuelve None si el nodo no responde"""
+    try:
+        return SESSION.get(url)
+    except requests.exceptions.RequestException:
+        return None
+
 def check_volumes():
     print("🔍 Verificando estructura de volúmenes...")
     
-    # Check NameNode
-    try:
-        nn_resp = requests.get(NAMENODE_URL)
-        print("✅ NameNode respondiendo")
-    except:
-        print("❌ NameNode no disponible")
-        return False
-    
-    # Check DataNodes
     datanodes = [
         "http://localhost:5001",
         "http://localhost:5002", 
         "http://localhost:5003"
     ]
     
+    # Lanzar todas las consultas en paralelo y mostrar los resultados en orden
+    urls = [NAMENODE_URL]
+    for dn_url in datanodes:
+        urls += [f"{dn_url}/", f"{dn_url}/storage_info"]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        responses = dict(zip(urls, executor.map(_safe_get, urls)))
+    
+    # Check NameNode
+    if responses[NAMENODE_URL] is None:
+        print("❌ NameNode no disponible")
+        return False
+    print("✅ NameNode respondiendo")
+    
+    # Check DataNodes
     for dn_url in datanodes:
         try:
-            dn_resp = requests.get(f"{dn_url}/")
+            dn_resp = responses[f"{dn_url}/"]
             dn_info = dn_resp.json()
             print(f"✅ {dn_url}: {dn_info['total_blocks']} blocks, {dn_info['total_size']} bytes")
             
             # Check storage info
-            storage_resp = requests.get(f"{dn_url}/storage_info")
+            storage_resp = responses[f"{dn_url}/storage_info"]
             storage_info = storage_resp.json()
             print(f"   📦 Storage: {storage_info['storage_root']}")
             print(f"   💾 Free: {storage_info['free_space']} bytes")
@@ -7,13 +7,22 @@ import os
 import sys
 import json
 import math
-import uuid
+import mmap
+import hashlib
+import queue
+import struct
 import click
+import orjson
 import requests
+import zstandard
+from requests.adapters import HTTPAdapter
 from urllib.parse import quote
 from dotenv import load_dotenv
 from pathlib import Path
 import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Optional
 
 # Cargar configuración
@@ -25,6 +34,42 @@ DEFAULT_BLOCK_SIZE_MB = int(os.getenv("BLOCK_SIZE_MB", "4"))
 DEFAULT_BLOCK_SIZE = DEFAULT_BLOCK_SIZE_MB * 1024 * 1024
 TOKEN_FILE = os.getenv("TOKEN_FILE", ".griddfs_token")
 MAX_RETRIES = int(os.getenv("MAX_RETRIES", "3"))
+# Caché en disco de la lista de DataNodes, compartida entre comandos
+DATANODES_CACHE_FILE = os.getenv("DATANODES_CACHE_FILE", ".griddfs_datanodes.json")
+DATANODES_CACHE_TTL = float(os.getenv("DATANODES_CACHE_TTL", "30"))
+# Comprimir con zstd los bloques que se reducen al menos un 10% (opcional: la
+# mayoría de los datos ya vienen comprimidos y cambia el id de los bloques)
+COMPRESS_BLOCKS = os.getenv("COMPRESS_BLOCKS", "false").lower() == "true"
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", "3"))
+# Bloques por consulta /exists_batch mientras se calcula el resto de digests
+EXISTS_BATCH_SIZE = int(os.getenv("EXISTS_BATCH_SIZE", "256"))
+# Subidas simultáneas como máximo hacia un mismo DataNode
+MAX_PARALLEL_PER_DATANODE = int(os.getenv("MAX_PARALLEL_PER_DATANODE", "4"))
+# Los bloques pequeños se agrupan en lotes de hasta estos bytes por petición
+UPLOAD_BATCH_BYTES = int(os.getenv("UPLOAD_BATCH_BYTES", str(4 * 1024 * 1024)))
+# Longitudes del formato de /upload_blocks_batch: u32 big-endian
+_BATCH_LEN = struct.Struct("!I")
+# Separadores de ruta que no pueden aparecer en un block_id
+_SAFE_ID_TABLE = str.maketrans({"/": "_", "\\": "_"})
+
+def _safe_block_prefix(remote_name: str) -> str:
+    """Prefijo de los block_id de un archivo, saneado con las mismas reglas que
+    sanitize_block_id del DataNode para que el id enviado sea el que guarda"""
+    return remote_name.translate(_SAFE_ID_TABLE).replace("..", "")
+
+# Sesión HTTP compartida: reutiliza conexiones keep-alive hacia el NameNode
+# y los DataNodes en lugar de abrir una conexión TCP por petición. Sin
+# reintentos en el adaptador: make_request ya reintenta (MAX_RETRIES), los
+# sondeos con timeout corto deben fallar rápido y los cuerpos generados
+# (RegistrationStream) no se pueden reenviar
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=0
+)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
 
 class GridDFSClient:
     """Cliente GridDFS con manejo mejorado de errores y reintentos"""
@@ -32,36 +77,55 @@ class GridDFSClient:
     def __init__(self):
         self.namenode_url = NAMENODE_URL
         self.token_file = TOKEN_FILE
+        # Caché en proceso: el token y los DataNodes se consultan una vez por comando
+        self._token: Optional[str] = None
+        self._headers: Optional[Dict[str, str]] = None
+        self._datanodes: Optional[List[str]] = None
+        # True si la lista de DataNodes salió de la caché en disco
+        self.datanodes_cached = False
         
     def save_token(self, token: str):
         """Guardar token de autenticación"""
         try:
             with open(self.token_file, "w") as f:
                 f.write(token)
+            self._token = token
+            self._headers = None
         except Exception as e:
             click.echo(f"Error guardando token: {e}")
             
     def load_token(self) -> Optional[str]:
         """Cargar token de autenticación"""
+        if self._token is not None:
+            return self._token
         try:
             if os.path.exists(self.token_file):
                 with open(self.token_file, "r") as f:
-                    return f.read().strip()
+                    self._token = f.read().strip()
+                    return self._token
         except Exception as e:
             click.echo(f"Error cargando token: {e}")
         return None
         
+    def clear_token(self):
+        """Olvidar el token en memoria (p.ej. tras un 401 o un cleanup)"""
+        self._token = None
+        self._headers = None
+        
     def auth_headers(self) -> Dict[str, str]:
-        """Obtener headers de autenticación"""
-        token = self.load_token()
-        if not token:
-            raise click.ClickException("No estás logueado. Usa 'griddfs login' primero.")
-        return {"token": token}
+        """Obtener headers de autenticación (el mismo dict en todo el comando:
+        no copiarlo ni modificarlo)"""
+        if self._headers is None:
+            token = self.load_token()
+            if not token:
+                raise click.ClickException("No estás logueado. Usa 'griddfs login' primero.")
+            self._headers = {"token": token}
+        return self._headers
         
     def check_connection(self) -> bool:
         """Verificar conexión con NameNode"""
         try:
-            response = requests.get(f"{self.namenode_url}/", timeout=10)
+            response = SESSION.get(f"{self.namenode_url}/", timeout=10)
             return response.status_code == 200
         except Exception:
             return False
@@ -70,7 +134,10 @@ class GridDFSClient:
         """Hacer petición HTTP con reintentos"""
         for attempt in range(MAX_RETRIES):
             try:
-                response = requests.request(method, url, timeout=30, **kwargs)
+                response = SESSION.request(method, url, timeout=30, **kwargs)
+                if response.status_code == 401:
+                    # Token rechazado: se vuelve a leer del disco la próxima vez
+                    self.clear_token()
                 return response
             except requests.exceptions.ConnectionError:
                 if attempt == MAX_RETRIES - 1:
@@ -81,11 +148,57 @@ class GridDFSClient:
                     raise click.ClickException("Timeout conectando al NameNode.")
                 time.sleep(2)
         
-    def get_datanodes(self) -> List[str]:
-        """Obtener lista de DataNodes activos"""
-        response = self.make_request("GET", f"{self.namenode_url}/datanodes", headers=self.auth_headers())
-        response.raise_for_status()
-        return response.json().get("datanodes", [])
+    def _load_datanodes_cache(self) -> Optional[List[str]]:
+        """Lista de DataNodes guardada por un comando reciente, si sigue vigente"""
+        try:
+            with open(DATANODES_CACHE_FILE, "rb") as f:
+                cached = orjson.loads(f.read())
+        except (OSError, ValueError):
+            return None
+        if (not isinstance(cached, dict) or cached.get("namenode") != self.namenode_url
+                or time.time() - cached.get("time", 0) >= DATANODES_CACHE_TTL):
+            return None
+        return cached.get("datanodes") or None
+
+    def _save_datanodes_cache(self, datanodes: List[str]):
+        """Guardar la lista de DataNodes para los próximos comandos"""
+        try:
+            with open(DATANODES_CACHE_FILE, "wb") as f:
+                f.write(orjson.dumps({"namenode": self.namenode_url, "time": time.time(), "datanodes": datanodes}))
+        except OSError:
+            pass  # La caché es opcional
+        
+    def cached_datanodes(self) -> Optional[List[str]]:
+        """Lista de DataNodes ya conocida (en proceso o en disco), sin pedirla"""
+        if self._datanodes is None:
+            self._datanodes = self._load_datanodes_cache()
+            self.datanodes_cached = self._datanodes is not None
+        return self._datanodes
+
+    def set_datanodes(self, datanodes: List[str]):
+        """Guardar una lista de DataNodes recién obtenida del NameNode"""
+        self._datanodes = datanodes
+        self.datanodes_cached = False
+        self._save_datanodes_cache(datanodes)
+        
+    def get_datanodes(self, refresh: bool = False) -> List[str]:
+        """Obtener lista de DataNodes activos (de la caché si es reciente)"""
+        if refresh:
+            self.invalidate_datanodes()
+        if self.cached_datanodes() is None:
+            response = self.make_request("GET", f"{self.namenode_url}/datanodes", headers=self.auth_headers())
+            response.raise_for_status()
+            self.set_datanodes(response.json().get("datanodes", []))
+        return self._datanodes
+
+    def invalidate_datanodes(self):
+        """Descartar la lista de DataNodes (p.ej. si alguno dejó de responder)"""
+        self._datanodes = None
+        self.datanodes_cached = False
+        try:
+            os.remove(DATANODES_CACHE_FILE)
+        except OSError:
+            pass
 
 # Instancia global del cliente
 client = GridDFSClient()
@@ -154,30 +267,285 @@ def login(username: str, password: str):
     except Exception as e:
         click.echo(f"Error: {e}")
 
+def _block_digest(mapped: mmap.mmap, index: int, block_size: int) -> str:
+    """SHA-256 del contenido de un bloque, truncado a 128 bits en hexadecimal"""
+    with memoryview(mapped)[index * block_size:(index + 1) * block_size] as chunk:
+        return hashlib.sha256(chunk).hexdigest()[:32]
+
+def _block_digests(hasher: ThreadPoolExecutor, mapped: mmap.mmap, total_blocks: int, block_size: int):
+    """Digests de los bloques en orden, calculados en paralelo con como mucho
+    2 * EXISTS_BATCH_SIZE pendientes (no se encola el archivo entero)"""
+    window = 2 * EXISTS_BATCH_SIZE
+    pending = deque()
+    next_index = 0
+    for _ in range(total_blocks):
+        while next_index < total_blocks and len(pending) < window:
+            pending.append(hasher.submit(_block_digest, mapped, next_index, block_size))
+            next_index += 1
+        yield pending.popleft().result()
+
+def _find_stored_blocks(datanodes: List[str], expected_sizes: Dict[str, Optional[int]]) -> Dict[str, str]:
+    """Preguntar a cada DataNode, en una sola petición, qué bloques ya tiene
+    (un tamaño esperado None acepta cualquier tamaño, p.ej. bloques comprimidos)"""
+    # El mismo cuerpo para todos los DataNodes, serializado una sola vez
+    body = orjson.dumps({"block_ids": list(expected_sizes)})
+
+    def fetch_stored(datanode: str) -> Dict[str, int]:
+        try:
+            response = SESSION.post(
+                f"{datanode}/exists_batch",
+                data=body,
+                headers={"Content-Type": "application/json"},
+                timeout=5
+            )
+        except requests.exceptions.RequestException:
+            return {}
+        if response.status_code != 200:
+            return {}
+        return response.json().get("blocks", {})
+
+    # Consultas en paralelo: un DataNode colgado cuesta un timeout, no uno por nodo
+    stored = {}
+    with ThreadPoolExecutor(max_workers=len(datanodes)) as executor:
+        for datanode, blocks in zip(datanodes, executor.map(fetch_stored, datanodes)):
+            for block_id, size in blocks.items():
+                # Un bloque a medio escribir no tiene el tamaño esperado
+                expected = expected_sizes.get(block_id, -1)
+                if expected == size or (expected is None and size > 0):
+                    stored.setdefault(block_id, datanode)
+    return stored
+
+class DatanodeScheduler:
+    """Asigna cada bloque al DataNode con menos subidas en curso, sin pasar
+    de max_per_datanode subidas propias por nodo"""
+
+    def __init__(self, datanodes: List[str], initial_load: Dict[str, int],
+                 max_per_datanode: int = MAX_PARALLEL_PER_DATANODE):
+        self._cond = threading.Condition()
+        self._inflight = {dn: initial_load.get(dn, 0) for dn in datanodes}
+        self._assigned = {dn: 0 for dn in datanodes}
+        self._own = {dn: 0 for dn in datanodes}
+        self._max_per_datanode = max(1, max_per_datanode)
+
+    def acquire(self) -> str:
+        """Elegir DataNode para el siguiente bloque y contarlo como en curso;
+        si todos están al límite, esperar a que alguno termine una subida"""
+        with self._cond:
+            while True:
+                # Un nodo lento solo retiene sus propias ranuras: los bloques
+                # siguientes van a los nodos que aún tienen capacidad
+                available = [dn for dn in self._inflight if self._own[dn] < self._max_per_datanode]
+                if available:
+                    break
+                self._cond.wait()
+            # A igual carga gana el que menos bloques ha recibido (round-robin)
+            datanode = min(available, key=lambda dn: (self._inflight[dn], self._assigned[dn]))
+            self._inflight[datanode] += 1
+            self._assigned[datanode] += 1
+            self._own[datanode] += 1
+            return datanode
+
+    def release(self, datanode: str):
+        """Marcar como terminada una subida al DataNode"""
+        with self._cond:
+            self._inflight[datanode] -= 1
+            self._own[datanode] -= 1
+            self._cond.notify()
+
+def _datanode_loads(datanodes: List[str]) -> Dict[str, int]:
+    """Consultar /stats de cada DataNode; los que no responden se descartan"""
+    def fetch_load(datanode: str):
+        try:
+            response = SESSION.get(f"{datanode}/stats", timeout=5)
+        except requests.exceptions.RequestException:
+            return datanode, None
+        if response.status_code != 200:
+            return datanode, 0
+        return datanode, response.json().get("inflight", 0)
+
+    with ThreadPoolExecutor(max_workers=len(datanodes)) as executor:
+        return {dn: load for dn, load in executor.map(fetch_load, datanodes) if load is not None}
+
+def _encode_block(chunk: memoryview, safe_block_id: str, compress: bool):
+    """Devolver (cuerpo, block_id, encoding) del bloque, comprimido si compensa"""
+    if compress:
+        compressed = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL).compress(chunk)
+        # Los bloques comprimidos llevan sufijo propio: nunca se confunden
+        # con la versión sin comprimir del mismo contenido
+        if len(compressed) < 0.9 * len(chunk):
+            return compressed, safe_block_id + ".zst", "zstd"
+    return chunk, safe_block_id, None
+
+def _block_meta(index: int, block_id: str, datanode: str, encoding: Optional[str]) -> Dict:
+    """Metadata de un bloque subido, tal como se registra en el NameNode"""
+    block_meta = {
+        "index": index,
+        "block_id": block_id,
+        "datanode": datanode
+    }
+    if encoding:
+        block_meta["encoding"] = encoding
+    return block_meta
+
+def _upload_block(index: int, safe_block_id: str, mapped: mmap.mmap, block_size: int,
+                  scheduler: DatanodeScheduler, compress: bool) -> Dict:
+    """Subir un bloque al DataNode menos cargado y devolver su metadata"""
+    # La vista se libera al salir para que el mmap pueda cerrarse
+    with memoryview(mapped)[index * block_size:(index + 1) * block_size] as chunk:
+        body, safe_block_id, encoding = _encode_block(chunk, safe_block_id, compress)
+        headers = {"Content-Type": "application/octet-stream"}
+        if encoding:
+            headers["Content-Encoding"] = encoding
+
+        datanode = scheduler.acquire()
+        try:
+            upload_response = SESSION.post(
+                f"{datanode}/upload_block/{safe_block_id}",
+                data=body,
+                headers=headers,
+                timeout=120
+            )
+        finally:
+            scheduler.release(datanode)
+    if upload_response.status_code != 200:
+        raise click.ClickException(f"Error subiendo bloque {index} a {datanode}: {upload_response.text}")
+    return _block_meta(index, safe_block_id, datanode, encoding)
+
+def _upload_blocks(items: List[tuple], mapped: mmap.mmap, block_size: int,
+                   scheduler: DatanodeScheduler, compress: bool) -> List[Dict]:
+    """Subir un grupo de bloques (index, block_id) en una sola petición al
+    DataNode menos cargado y devolver la metadata de cada uno"""
+    if len(items) == 1:
+        return [_upload_block(*items[0], mapped, block_size, scheduler, compress)]
+
+    # Cuerpo del lote: u32 len(id) | id | u32 len(datos) | datos, por bloque
+    payload = bytearray()
+    encoded = []
+    for index, safe_block_id in items:
+        with memoryview(mapped)[index * block_size:(index + 1) * block_size] as chunk:
+            body, block_id, encoding = _encode_block(chunk, safe_block_id, compress)
+            raw_id = block_id.encode("utf-8")
+            payload += _BATCH_LEN.pack(len(raw_id))
+            payload += raw_id
+            payload += _BATCH_LEN.pack(len(body))
+            payload += body
+            del body
+        encoded.append((index, block_id, encoding))
+
+    datanode = scheduler.acquire()
+    try:
+        upload_response = SESSION.post(
+            f"{datanode}/upload_blocks_batch",
+            data=payload,
+            headers={"Content-Type": "application/octet-stream"},
+            timeout=120
+        )
+    finally:
+        scheduler.release(datanode)
+    if upload_response.status_code != 200:
+        raise click.ClickException(
+            f"Error subiendo bloques {items[0][0]}-{items[-1][0]} a {datanode}: {upload_response.text}")
+
+    # El DataNode puede sanear los ids: solo se registran los que confirmó tal cual
+    stored_ids = {b["block_id"] for b in upload_response.json().get("blocks", [])}
+    missing = [index for index, block_id, _ in encoded if block_id not in stored_ids]
+    if missing:
+        raise click.ClickException(f"El DataNode {datanode} no confirmó los bloques {missing}")
+    return [_block_meta(index, block_id, datanode, encoding) for index, block_id, encoding in encoded]
+
+class RegistrationStream:
+    """Registro incremental de un archivo: una sola petición NDJSON al NameNode,
+    con una línea por bloque a medida que se suben"""
+
+    def __init__(self, header: Dict):
+        self._lines = queue.Queue()
+        self._lines.put(orjson.dumps(header) + b"\n")
+        self._response = None
+        self._error = None
+        self._thread = threading.Thread(target=self._post, daemon=True)
+        self._thread.start()
+
+    def _body(self):
+        while True:
+            line = self._lines.get()
+            if line is None:
+                return
+            yield line
+
+    def _post(self):
+        try:
+            self._response = SESSION.post(
+                f"{client.namenode_url}/register_file_stream",
+                data=self._body(),
+                headers={"Content-Type": "application/x-ndjson", **client.auth_headers()},
+                timeout=30
+            )
+        except Exception as e:
+            self._error = e
+
+    def send(self, block_meta: Dict):
+        """Confirmar un bloque subido (se puede llamar desde cualquier hilo)"""
+        self._lines.put(orjson.dumps(block_meta) + b"\n")
+
+    def abort(self):
+        """Cerrar el cuerpo sin esperar resultado: el NameNode conserva lo confirmado"""
+        if self._thread.is_alive():
+            self._lines.put(None)
+            self._thread.join()
+
+    def close(self) -> requests.Response:
+        """Cerrar el cuerpo y devolver la respuesta del NameNode"""
+        self.abort()
+        if self._error is not None:
+            raise self._error
+        return self._response
+
 @cli.command()
 @click.argument("local_path", type=click.Path(exists=True, dir_okay=False))
 @click.argument("remote_name", required=False)
 @click.option("--block-size", type=int, default=DEFAULT_BLOCK_SIZE, 
               help=f"Tamaño de bloque en bytes (por defecto: {DEFAULT_BLOCK_SIZE})")
 @click.option("--progress/--no-progress", default=True, help="Mostrar progreso de subida")
-def put(local_path: str, remote_name: Optional[str], block_size: int, progress: bool):
+@click.option("--compress/--no-compress", default=COMPRESS_BLOCKS,
+              help="Comprimir con zstd los bloques compresibles")
+def put(local_path: str, remote_name: Optional[str], block_size: int, progress: bool, compress: bool):
     """Subir archivo al sistema distribuido"""
     try:
-        # Verificar conexión
-        if not client.check_connection():
-            raise click.ClickException("No hay conexión con el NameNode")
-            
         if not remote_name:
             remote_name = os.path.basename(local_path)
         
-        # Obtener DataNodes activos
-        datanodes = client.get_datanodes()
+        file_size = os.path.getsize(local_path)
+        total_blocks = math.ceil(file_size / block_size)
+
+        # Una sola petición antes de subir: bloques ya confirmados de una
+        # subida anterior interrumpida y, si no están en caché, los DataNodes
+        # activos. Si el NameNode no responde, esta misma petición falla
+        datanodes = client.cached_datanodes()
+        begin_response = client.make_request(
+            "POST",
+            f"{client.namenode_url}/begin_upload",
+            json={
+                "filename": remote_name,
+                "size": file_size,
+                "block_size": block_size,
+                "include_datanodes": datanodes is None
+            },
+            headers=client.auth_headers()
+        )
+        begin_response.raise_for_status()
+        upload_status = begin_response.json()
+        if datanodes is None:
+            datanodes = upload_status.get("datanodes", [])
+            client.set_datanodes(datanodes)
+        
         if not datanodes:
             raise click.ClickException("No hay DataNodes activos")
         
-        file_size = os.path.getsize(local_path)
-        total_blocks = math.ceil(file_size / block_size)
-        blocks_meta = []
+        if upload_status["exists"]:
+            raise click.ClickException(f"El archivo '{remote_name}' ya existe")
+        committed_blocks = {}
+        if (upload_status["size"], upload_status["block_size"]) == (file_size, block_size):
+            committed_blocks = {b["index"]: b for b in upload_status["blocks"]}
         
         if progress:
             click.echo(f"Subiendo '{local_path}' como '{remote_name}'")
@@ -186,51 +554,142 @@ def put(local_path: str, remote_name: Optional[str], block_size: int, progress:
             click.echo(f"Tamaño de bloque: {block_size:,} bytes")
             click.echo(f"DataNodes disponibles: {len(datanodes)}")
         
-        # Subir bloques usando round-robin
+        # Cada bloque va al DataNode con menos subidas en curso, partiendo de
+        # la carga que reporta cada uno; los que no responden se descartan
+        loads = _datanode_loads(datanodes)
+        if len(loads) < len(datanodes) and client.datanodes_cached:
+            # La lista en caché está desactualizada: pedirla de nuevo
+            datanodes = client.get_datanodes(refresh=True)
+            loads = _datanode_loads(datanodes) if datanodes else {}
+        if not loads:
+            raise click.ClickException("Ningún DataNode activo responde")
+        # En adelante solo se usan los DataNodes que respondieron a /stats
+        datanodes = list(loads)
+        scheduler = DatanodeScheduler(datanodes, loads)
+
+        # Subir bloques en paralelo. El semáforo limita las peticiones
+        # encoladas para cortar rápido si una subida falla
+        workers = min(32, 4 * len(datanodes))
+        # Bloques por petición: los bloques pequeños viajan en lotes para no
+        # pagar una petición HTTP por bloque
+        blocks_per_request = max(1, UPLOAD_BATCH_BYTES // max(1, block_size))
+        inflight = threading.BoundedSemaphore(2 * workers)
+        failed = threading.Event()
+        futures = []
+
+        def on_block_done(future):
+            if not future.cancelled():
+                if future.exception() is not None:
+                    failed.set()
+                else:
+                    for block_meta in future.result():
+                        registration.send(block_meta)
+            inflight.release()
+
         with open(local_path, "rb") as f:
-            for i in range(total_blocks):
-                chunk = f.read(block_size)
-                if not chunk:
-                    break
-                    
-                block_id = f"{remote_name}__{i}__{uuid.uuid4().hex}"
-                safe_block_id = block_id.replace("/", "_").replace("\\", "_")
-                
-                # Seleccionar DataNode usando round-robin
-                datanode = datanodes[i % len(datanodes)]
-                
-                # Subir bloque
-                files = {"file": (safe_block_id, chunk, "application/octet-stream")}
-                upload_url = f"{datanode}/upload_block/{safe_block_id}"
-                
-                upload_response = requests.post(upload_url, files=files, timeout=120)
-                if upload_response.status_code != 200:
-                    raise click.ClickException(f"Error subiendo bloque {i} a {datanode}: {upload_response.text}")
-                
-                blocks_meta.append({
-                    "index": i,
-                    "block_id": safe_block_id,
-                    "datanode": datanode
+            # Mapear el archivo en memoria: cada bloque se envía como una vista
+            # del mapa, sin leerlo a un bytes intermedio
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if file_size else None
+            try:
+                # Registrar el archivo en el NameNode mientras se suben los
+                # bloques: cada bloque se confirma en cuanto termina
+                registration = RegistrationStream({
+                    "filename": remote_name,
+                    "size": file_size,
+                    "block_size": block_size,
+                    "total_blocks": total_blocks
                 })
-                
-                if progress:
-                    click.echo(f"  Bloque {i+1}/{total_blocks} -> {datanode} ✓")
-        
-        # Registrar archivo en NameNode
-        registration = {
-            "filename": remote_name,
-            "size": file_size,
-            "block_size": block_size,
-            "blocks": blocks_meta
-        }
-        
-        reg_response = client.make_request(
-            "POST",
-            f"{client.namenode_url}/register_file",
-            json=registration,
-            headers=client.auth_headers()
-        )
+
+                # Pipeline: los digests se calculan en paralelo (hashlib libera
+                # el GIL y usa las instrucciones SHA de la CPU si las hay)
+                # mientras se consultan los bloques ya almacenados y se suben
+                # los anteriores, por lotes de EXISTS_BATCH_SIZE
+                hash_workers = min(8, os.cpu_count() or 1)
+                # Solo el nombre remoto puede traer separadores o "..": el
+                # índice y el digest ya son seguros
+                safe_prefix = _safe_block_prefix(remote_name)
+                with ThreadPoolExecutor(max_workers=hash_workers) as hasher, \
+                        ThreadPoolExecutor(max_workers=workers) as executor:
+                    try:
+                        digests = _block_digests(hasher, mapped, total_blocks, block_size)
+                        for batch_start in range(0, total_blocks, EXISTS_BATCH_SIZE):
+                            if failed.is_set():
+                                break
+
+                            # El id de cada bloque incluye el SHA-256 de su contenido:
+                            # si un DataNode ya tiene ese bloque (p.ej. un put
+                            # reintentado o una versión con pocos cambios) no se
+                            # vuelve a subir
+                            batch = []
+                            pending_ids = {}
+                            for i in range(batch_start, min(batch_start + EXISTS_BATCH_SIZE, total_blocks)):
+                                safe_block_id = f"{safe_prefix}__{i}__{next(digests)}"
+                                batch.append((i, safe_block_id))
+                                committed = committed_blocks.get(i)
+                                if committed is None or committed["block_id"] not in (safe_block_id, safe_block_id + ".zst"):
+                                    pending_ids[safe_block_id] = min(block_size, file_size - i * block_size)
+                                    # También la versión comprimida: un put anterior con
+                                    # --compress pudo dejar el bloque almacenado así
+                                    pending_ids[safe_block_id + ".zst"] = None
+
+                            stored_blocks = _find_stored_blocks(datanodes, pending_ids) if pending_ids else {}
+
+                            to_upload = []
+                            for i, safe_block_id in batch:
+                                if safe_block_id not in pending_ids:
+                                    if progress:
+                                        click.echo(f"  Bloque {i+1}/{total_blocks} ya registrado ✓")
+                                    continue
+
+                                stored_id = next((candidate for candidate in (safe_block_id, safe_block_id + ".zst")
+                                                  if candidate in stored_blocks), None)
+                                if stored_id is not None:
+                                    block_meta = {
+                                        "index": i,
+                                        "block_id": stored_id,
+                                        "datanode": stored_blocks[stored_id]
+                                    }
+                                    if stored_id != safe_block_id:
+                                        block_meta["encoding"] = "zstd"
+                                    registration.send(block_meta)
+                                    if progress:
+                                        click.echo(f"  Bloque {i+1}/{total_blocks} ya almacenado en {stored_blocks[stored_id]} ✓")
+                                    continue
+
+                                to_upload.append((i, safe_block_id))
+
+                            for start in range(0, len(to_upload), blocks_per_request):
+                                inflight.acquire()
+                                if failed.is_set():
+                                    inflight.release()
+                                    break
+
+                                group = to_upload[start:start + blocks_per_request]
+                                future = executor.submit(_upload_blocks, group, mapped, block_size, scheduler, compress)
+                                future.add_done_callback(on_block_done)
+                                futures.append(future)
+
+                        for future in futures:
+                            for block_meta in future.result():
+                                if progress:
+                                    click.echo(f"  Bloque {block_meta['index']+1}/{total_blocks} -> {block_meta['datanode']} ✓")
+                    except BaseException:
+                        for future in futures:
+                            future.cancel()
+                        # Sin esto, salir del with esperaría a los digests pendientes
+                        hasher.shutdown(wait=False, cancel_futures=True)
+                        registration.abort()
+                        # Un DataNode pudo caerse: el próximo comando pide la lista de nuevo
+                        client.invalidate_datanodes()
+                        raise
+            finally:
+                if mapped is not None:
+                    mapped.close()
+
+        reg_response = registration.close()
         reg_response.raise_for_status()
+        if not reg_response.json().get("complete"):
+            raise click.ClickException("El NameNode no confirmó todos los bloques; vuelve a ejecutar put para reanudar")
         
         click.echo("Archivo subido exitosamente")
         
@@ -242,6 +701,57 @@ def put(local_path: str, remote_name: Optional[str], block_size: int, progress:
     except Exception as e:
         click.echo(f"Error: {e}")
 
+_write_lock = threading.Lock()
+
+def _write_at(fd: int, data: memoryview, offset: int):
+    """Escribir datos en una posición del archivo sin depender del cursor compartido"""
+    if hasattr(os, "pwrite"):
+        while data:
+            written = os.pwrite(fd, data, offset)
+            data = data[written:]
+            offset += written
+    else:
+        # Windows no tiene pwrite: serializar seek + write
+        with _write_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            while data:
+                data = data[os.write(fd, data):]
+
+def _download_block(block: Dict, block_size: int, fd: int, buffers: queue.LifoQueue) -> int:
+    """Descargar un bloque y escribirlo en su offset del archivo de salida"""
+    block_url = f"{block['datanode']}/block/{block['block_id']}"
+
+    block_response = SESSION.get(block_url, stream=True, timeout=120)
+    if block_response.status_code != 200:
+        raise click.ClickException(f"Error descargando bloque {block['index']} desde {block_url}")
+
+    # Reutilizar buffers de bloques ya escritos en lugar de asignar uno nuevo
+    try:
+        buffer = buffers.get_nowait()
+    except queue.Empty:
+        buffer = bytearray(block_size)
+
+    try:
+        with memoryview(buffer) as view:
+            # Leer del socket directo al buffer: readinto pide todo lo que
+            # falta del bloque en vez de iterar chunks de 1MB en Python
+            received = 0
+            while True:
+                read = block_response.raw.readinto(view[received:])
+                if not read:
+                    break
+                received += read
+
+            data = view[:received]
+            if block.get("encoding") == "zstd":
+                data = memoryview(zstandard.ZstdDecompressor().decompress(data))
+            _write_at(fd, data, block["index"] * block_size)
+            written = len(data)
+            data.release()
+    finally:
+        buffers.put(buffer)
+    return written
+
 @cli.command()
 @click.argument("remote_name")
 @click.argument("output_path", type=click.Path(dir_okay=False))
@@ -270,23 +780,37 @@ def get(remote_name: str, output_path: str, progress: bool):
             click.echo(f"Descargando '{remote_name}' -> '{output_path}'")
             click.echo(f"Bloques a descargar: {len(blocks)}")
         
-        # Descargar y reconstruir archivo
-        with open(output_path, "wb") as out_file:
-            for i, block in enumerate(blocks):
-                block_url = f"{block['datanode']}/block/{block['block_id']}"
-                
-                block_response = requests.get(block_url, stream=True, timeout=120)
-                if block_response.status_code != 200:
-                    raise click.ClickException(f"Error descargando bloque {i} desde {block_url}")
-                
-                block_size = 0
-                for chunk in block_response.iter_content(chunk_size=1024*1024):
-                    if chunk:
-                        out_file.write(chunk)
-                        block_size += len(chunk)
-                
-                if progress:
-                    click.echo(f"  Bloque {i+1}/{len(blocks)} ({block_size:,} bytes) ✓")
+        # Descargar bloques en paralelo y escribir cada uno en su posición
+        # dentro del archivo de salida, dimensionado de antemano
+        block_size = metadata.get("block_size", DEFAULT_BLOCK_SIZE)
+        fd = os.open(output_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+        try:
+            file_size = metadata.get("size", 0)
+            os.ftruncate(fd, file_size)
+            # Reservar los extents de una vez para que las escrituras paralelas
+            # no compitan asignando espacio (solo POSIX)
+            if file_size and hasattr(os, "posix_fallocate"):
+                try:
+                    os.posix_fallocate(fd, 0, file_size)
+                except OSError:
+                    pass  # El filesystem no soporta fallocate; basta con ftruncate
+
+            # Pool de buffers de bloque: como mucho uno por worker
+            buffers = queue.LifoQueue()
+            with ThreadPoolExecutor(max_workers=min(16, len(blocks))) as executor:
+                futures = [executor.submit(_download_block, block, block_size, fd, buffers) for block in blocks]
+                try:
+                    for i, future in enumerate(futures):
+                        received = future.result()
+
+                        if progress:
+                            click.echo(f"  Bloque {i+1}/{len(blocks)} ({received:,} bytes) ✓")
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            os.close(fd)
         
         click.echo("Descarga completada")
         
@@ -415,6 +939,23 @@ def datanodes(detailed: bool):
             
         click.echo(f"DataNodes activos ({len(datanodes_list)}):")
         
+        def probe(node):
+            # Intentar obtener info directa del DataNode
+            node_url = node if isinstance(node, str) else node.get('url', str(node))
+            try:
+                return SESSION.get(f"{node_url}/", timeout=5)
+            except Exception as e:
+                return e
+        
+        # Consultar en paralelo los DataNodes en formato simple; se imprimen
+        # en el orden original
+        simple = [i for i, node in enumerate(datanodes_list) if not (detailed and isinstance(node, dict))]
+        probes = [None] * len(datanodes_list)
+        if simple:
+            with ThreadPoolExecutor(max_workers=min(16, len(simple))) as executor:
+                for i, result in zip(simple, executor.map(probe, [datanodes_list[i] for i in simple])):
+                    probes[i] = result
+        
         for i, node in enumerate(datanodes_list, 1):
             if detailed and isinstance(node, dict):
                 click.echo(f"  {i}. {node['url']}")
@@ -424,9 +965,10 @@ def datanodes(detailed: bool):
             else:
                 # Para compatibilidad con formato simple
                 node_url = node if isinstance(node, str) else node.get('url', str(node))
+                node_response = probes[i - 1]
                 try:
-                    # Intentar obtener info directa del DataNode
-                    node_response = requests.get(f"{node_url}/", timeout=5)
+                    if isinstance(node_response, Exception):
+                        raise node_response
                     if node_response.status_code == 200:
                         node_info = node_response.json()
                         click.echo(f"  {i}. {node_url}")
@@ -515,6 +1057,8 @@ def status():
 def cleanup():
     """Limpiar token de autenticación"""
     try:
+        client.invalidate_datanodes()
+        client.clear_token()
         if os.path.exists(client.token_file):
             os.remove(client.token_file)
             click.echo("Token eliminado exitosamente")
@@ -532,6 +1076,7 @@ def config():
     click.echo(f"Tamaño de bloque por defecto: {DEFAULT_BLOCK_SIZE_MB} MB")
     click.echo(f"Archivo de token: {client.token_file}")
     click.echo(f"Máximos reintentos: {MAX_RETRIES}")
+    click.echo(f"Compresión zstd: {'activada' if COMPRESS_BLOCKS else 'desactivada'} (nivel {COMPRESSION_LEVEL})")
     
     # Verificar estado de autenticación
     token = client.load_token()
@@ -539,7 +1084,7 @@ def config():
         click.echo("Estado: Autenticado")
         # Verificar si el token es válido
         try:
-            response = requests.get(f"{client.namenode_url}/ls", 
+            response = SESSION.get(f"{client.namenode_url}/ls", 
                                   headers={"token": token}, timeout=5)
             if response.status_code == 200:
                 click.echo("Token: Válido")
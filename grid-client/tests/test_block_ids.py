@@ -0,0 +1,100 @@
+"""Los block_id que genera el cliente deben ser los que guarda el DataNode,
+tanto en la subida de un bloque como en la subida por lotes"""
+import importlib.util
+import mmap
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[2]
+STORAGE = tempfile.mkdtemp(prefix="griddfs-test-")
+os.environ["STORAGE_ROOT"] = os.path.join(STORAGE, "storage")
+os.environ["LOGS_PATH"] = os.path.join(STORAGE, "logs")
+for directory in ("storage/blocks", "storage/temp", "logs"):
+    os.makedirs(os.path.join(STORAGE, directory), exist_ok=True)
+
+sys.path.insert(0, str(ROOT / "grid-client"))
+import grid_cli  # noqa: E402
+
+_spec = importlib.util.spec_from_file_location("datanode_app", ROOT / "datanode" / "app.py")
+datanode = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(datanode)
+
+import uvicorn  # noqa: E402
+
+BLOCK_SIZE = 4096
+NAMES = ["a..b.bin", "c..d.bin", "dir/../x.bin", "a...b", "....", "plain.bin"]
+
+
+class BlockIdTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # DataNode real en un hilo: el cliente sube con la misma sesión requests
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        cls.datanode_url = f"http://127.0.0.1:{port}"
+        cls.server = uvicorn.Server(uvicorn.Config(datanode.app, port=port, lifespan="off", log_level="warning"))
+        cls.thread = threading.Thread(target=cls.server.run, daemon=True)
+        cls.thread.start()
+        while not cls.server.started:
+            time.sleep(0.01)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.should_exit = True
+        cls.thread.join()
+
+    def setUp(self):
+        self._file = tempfile.TemporaryFile()
+        self._file.write(os.urandom(3 * BLOCK_SIZE))
+        self._file.flush()
+        self.mapped = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def tearDown(self):
+        self.mapped.close()
+        self._file.close()
+
+    def block_ids(self, remote_name, count):
+        prefix = grid_cli._safe_block_prefix(remote_name)
+        return [(i, f"{prefix}__{i}__{grid_cli._block_digest(self.mapped, i, BLOCK_SIZE)}")
+                for i in range(count)]
+
+    def upload(self, items):
+        scheduler = grid_cli.DatanodeScheduler([self.datanode_url], {})
+        return grid_cli._upload_blocks(items, self.mapped, BLOCK_SIZE, scheduler, compress=False)
+
+    def assert_stored(self, metas, items):
+        self.assertEqual([meta["block_id"] for meta in metas], [block_id for _, block_id in items])
+        for meta in metas:
+            self.assertTrue(os.path.isfile(datanode.BLOCKS_DIR + meta["block_id"]), meta["block_id"])
+
+    def test_prefix_survives_datanode_sanitizing(self):
+        for name in NAMES:
+            for _, block_id in self.block_ids(name, 1):
+                self.assertEqual(datanode.sanitize_block_id(block_id), block_id, name)
+
+    def test_single_block_upload(self):
+        for name in NAMES:
+            items = self.block_ids(name, 1)
+            self.assert_stored(self.upload(items), items)
+
+    def test_batch_upload(self):
+        for name in NAMES:
+            items = self.block_ids(name, 3)
+            self.assert_stored(self.upload(items), items)
+
+
+def tearDownModule():
+    shutil.rmtree(STORAGE, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,12 +1,26 @@
-from fastapi import FastAPI, HTTPException, Header, Depends
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Header, Depends, Request
+from fastapi.responses import ORJSONResponse
+from fastapi.exceptions import RequestValidationError
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, ValidationError
 import secrets
+import hashlib
 import os
+import sys
+import queue
+import atexit
+import orjson
 import aiohttp
 import time
 import threading
 import logging
 import asyncio
+import sqlite3
+import operator
+import posixpath
+from functools import lru_cache
+from itertools import cycle, islice
+from contextlib import asynccontextmanager, contextmanager
 from typing import Dict, List, Optional
 from datetime import datetime, timedelta
 from pathlib import Path
@@ -16,8 +30,14 @@ STORAGE_PATH = os.getenv("STORAGE_PATH", "/app/data")
 HEARTBEAT_TIMEOUT = int(os.getenv("HEARTBEAT_TIMEOUT", "90"))
 HEARTBEAT_CHECK_INTERVAL = int(os.getenv("HEARTBEAT_CHECK_INTERVAL", "30"))
 TOKEN_EXPIRY_HOURS = int(os.getenv("TOKEN_EXPIRY_HOURS", "24"))
+# Iteraciones de PBKDF2 para las contraseñas guardadas
+PASSWORD_HASH_ITERATIONS = 200_000
 DEFAULT_BLOCK_SIZE = int(os.getenv("DEFAULT_BLOCK_SIZE", "67108864"))
 MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", "10737418240"))
+# Consultas simultáneas a DataNodes al verificar la integridad de un archivo
+HEALTH_CHECK_CONCURRENCY = int(os.getenv("HEALTH_CHECK_CONCURRENCY", "32"))
+# Bloques por consulta /exists_batch al verificar la integridad
+HEALTH_CHECK_BATCH_SIZE = 256
 
 logging.basicConfig(
     level=getattr(logging, LOG_LEVEL),
@@ -27,61 +47,371 @@ logger = logging.getLogger(__name__)
 
 _start_time = time.time()
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Sesión HTTP compartida con los DataNodes: conexiones keep-alive
+    # reutilizadas entre verificaciones en lugar de una sesión por bloque
+    app.state.http = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=64, keepalive_timeout=30),
+        timeout=aiohttp.ClientTimeout(total=10)
+    )
+    # Tokens que caducaron mientras el NameNode estaba parado
+    cleanup_expired_tokens()
+    status_task = asyncio.create_task(check_datanode_status())
+    try:
+        yield
+    finally:
+        status_task.cancel()
+        await app.state.http.close()
+
+
 app = FastAPI(
     title="GridDFS NameNode",
     description="NameNode central del sistema de archivos distribuido GridDFS",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    lifespan=lifespan,
+    # orjson serializa las respuestas grandes (/ls, /file) mucho más rápido
+    default_response_class=ORJSONResponse
 )
 Path(STORAGE_PATH).mkdir(parents=True, exist_ok=True)
 
 files: Dict = {}
 users: Dict = {}
+# Índice inverso sha256(token) -> usuario para autenticar cada petición en
+# O(1); el token en claro no se guarda en el NameNode
+token_hash_to_user: Dict[str, str] = {}
 directories: Dict = {}
 datanodes: Dict = {}
 datanode_status: Dict = {}
+# URLs de los DataNodes con status "active", mantenido junto a datanode_status
+active_dn: set = set()
 block_distribution_cache: Dict = {}
+# Subidas en curso registradas bloque a bloque: (usuario, ruta) -> bloques confirmados
+pending_uploads: Dict = {}
+
+# Persistencia de users, files y directories en SQLite (una fila por usuario
+# y por ruta); en memoria se mantienen los dicts y el árbol
+METADATA_DB = Path(STORAGE_PATH) / "namenode.db"
+_db_lock = threading.Lock()
+_db: Optional[sqlite3.Connection] = None
+
+
+class PathNode:
+    """Nodo del árbol de rutas de un usuario: subdirectorios y archivos directos"""
+    __slots__ = ("children", "files", "meta")
+
+    def __init__(self):
+        self.children: Dict[str, "PathNode"] = {}
+        self.files: Dict[str, Dict] = {}
+        # Metadatos del directorio si fue creado (mkdir o auto-creado); los
+        # nodos intermedios implícitos no aparecen en ls
+        self.meta: Optional[Dict] = None
+
+
+# Índice por usuario de files y directories como árbol de rutas: ls y rmdir
+# navegan hasta el nodo en lugar de recorrer todas las claves
+user_roots: Dict[str, PathNode] = {}
+# Rutas de archivos y directorios de cada usuario (para contarlas sin
+# recorrer files/directories enteros)
+user_files_index: Dict[str, set] = {}
+user_dirs_index: Dict[str, set] = {}
+_paths_lock = threading.Lock()
+
+
+@lru_cache(maxsize=4096)
+def normalize_path(path: str) -> str:
+    """Ruta absoluta canónica: una sola "/" inicial, sin "//", "." ni ".." y sin
+    "/" final (normpath conserva "//" inicial, por eso se quita antes)"""
+    # Internada: coincide por identidad con la clave guardada en files/directories
+    return sys.intern(posixpath.normpath("/" + path.lstrip("/")))
+
+
+def path_segments(path: str) -> List[str]:
+    return [segment for segment in path.split("/") if segment]
+
+
+def path_node(username: str, segments: List[str], create: bool = False) -> Optional[PathNode]:
+    """Nodo de una ruta en el árbol del usuario (llamar con _paths_lock)"""
+    node = user_roots.get(username)
+    if node is None:
+        if not create:
+            return None
+        node = user_roots[username] = PathNode()
+    for segment in segments:
+        child = node.children.get(segment)
+        if child is None:
+            if not create:
+                return None
+            child = node.children[sys.intern(segment)] = PathNode()
+        node = child
+    return node
+
+
+def prune_path(username: str, segments: List[str]):
+    """Quitar los nodos que quedaron vacíos al final de una ruta (con _paths_lock)"""
+    chain = [user_roots.get(username)]
+    for segment in segments:
+        if chain[-1] is None:
+            return
+        chain.append(chain[-1].children.get(segment))
+    for depth in range(len(segments), 0, -1):
+        node = chain[depth]
+        if node is None or node.children or node.files or node.meta is not None:
+            return
+        del chain[depth - 1].children[segments[depth - 1]]
+
+
+def intern_key(key: tuple) -> tuple:
+    """Clave (usuario, ruta) con ambas cadenas internadas: un solo objeto por
+    usuario en millones de claves y comparación por identidad al buscar"""
+    username, path = key
+    return sys.intern(username), sys.intern(path)
+
+
+def put_file(key: tuple, meta: Dict):
+    """Guardar un archivo en files y en el árbol de su usuario"""
+    key = intern_key(key)
+    username, path = key
+    *parent, name = path_segments(path) or [""]
+    with _paths_lock:
+        files[key] = meta
+        user_files_index.setdefault(username, set()).add(path)
+        path_node(username, parent, create=True).files[name] = meta
+
+
+def delete_file(key: tuple):
+    """Quitar un archivo de files y del árbol de su usuario"""
+    username, path = key
+    *parent, name = path_segments(path) or [""]
+    with _paths_lock:
+        files.pop(key, None)
+        user_files_index.get(username, set()).discard(path)
+        node = path_node(username, parent)
+        if node is not None:
+            node.files.pop(name, None)
+            prune_path(username, parent)
+
+
+def put_directory(key: tuple, meta: Dict):
+    """Guardar un directorio en directories y en el árbol de su usuario"""
+    key = intern_key(key)
+    username, path = key
+    with _paths_lock:
+        directories[key] = meta
+        user_dirs_index.setdefault(username, set()).add(path)
+        path_node(username, path_segments(path), create=True).meta = meta
+
+
+def delete_directory(key: tuple):
+    """Quitar un directorio de directories y del árbol de su usuario"""
+    username, path = key
+    segments = path_segments(path)
+    with _paths_lock:
+        directories.pop(key, None)
+        user_dirs_index.get(username, set()).discard(path)
+        node = path_node(username, segments)
+        if node is not None:
+            node.meta = None
+            prune_path(username, segments)
+
+
+# (segundo, timestamp ISO) para los campos de fecha de metadatos y respuestas
+_now_iso_cache = (0, "")
+
+
+def now_iso() -> str:
+    """Timestamp ISO del segundo actual, formateado una sola vez por segundo"""
+    global _now_iso_cache
+    second = int(time.time())
+    if second != _now_iso_cache[0]:
+        _now_iso_cache = (second, datetime.fromtimestamp(second).isoformat())
+    return _now_iso_cache[1]
+
+
+# Las líneas de log se encolan y un hilo aparte las escribe por lotes a
+# stdout y a namenode.log (abierto una sola vez), fuera de los endpoints
+LOG_BATCH_LINES = 256
+_log_queue: queue.Queue = queue.Queue(maxsize=10000)
 
 
 def log_namenode(message: str, level: str = "INFO"):
-    timestamp = datetime.now().isoformat()
-    log_entry = f"{timestamp} [NAMENODE-{level}] {message}"
-
     if level == "DEBUG" and LOG_LEVEL != "DEBUG":
         return
 
-    print(log_entry)
-
-    log_file = Path(STORAGE_PATH) / "namenode.log"
+    timestamp = datetime.now().isoformat()
     try:
-        with open(log_file, "a", encoding="utf-8") as f:
-            f.write(log_entry + "\n")
-    except Exception as e:
-        logger.error(f"Error escribiendo log: {e}")
+        _log_queue.put_nowait(f"{timestamp} [NAMENODE-{level}] {message}")
+    except queue.Full:
+        pass  # Con la cola llena se descarta la línea antes que bloquear la petición
 
 
-def check_datanode_status():
-    """Periodically check DataNode status"""
+def log_writer():
+    """Escribir las líneas encoladas por log_namenode, hasta LOG_BATCH_LINES por write"""
+    log_file = None
     while True:
-        time.sleep(30)
-        current_time = datetime.now()
-        inactive_nodes = []
+        entries = [_log_queue.get()]
+        while len(entries) < LOG_BATCH_LINES:
+            try:
+                entries.append(_log_queue.get_nowait())
+            except queue.Empty:
+                break
+        stop = None in entries
+        text = "".join(entry + "\n" for entry in entries if entry is not None)
+
+        sys.stdout.write(text)
+        sys.stdout.flush()
+        try:
+            if log_file is None:
+                log_file = open(Path(STORAGE_PATH) / "namenode.log", "a", encoding="utf-8")
+            log_file.write(text)
+            log_file.flush()
+        except Exception as e:
+            logger.error(f"Error escribiendo log: {e}")
+        if stop:
+            if log_file is not None:
+                log_file.close()
+            return
+
+
+def stop_log_writer():
+    """Vaciar la cola de logs al terminar el proceso"""
+    try:
+        _log_queue.put(None, timeout=1)
+    except queue.Full:
+        return
+    log_thread.join(timeout=5)
+
 
-        for dn_url in list(datanode_status.keys()):
-            last_heartbeat = datanode_status[dn_url]["last_heartbeat"]
-            if current_time - last_heartbeat > timedelta(seconds=HEARTBEAT_TIMEOUT):
-                if datanode_status[dn_url]["status"] == "active":
-                    datanode_status[dn_url]["status"] = "inactive"
-                    inactive_nodes.append(dn_url)
+log_thread = threading.Thread(target=log_writer, daemon=True)
+log_thread.start()
+atexit.register(stop_log_writer)
 
-        for node in inactive_nodes:
-            log_namenode(f"DataNode {node} marcado como inactivo", "WARNING")
 
+def sweep_inactive_datanodes():
+    """Marca como inactivos los DataNodes sin heartbeat reciente"""
+    # Reloj monotónico: un ajuste de la hora del sistema no marca nodos
+    current_time = time.monotonic()
+    inactive_nodes = []
 
-# Start status checker
-status_thread = threading.Thread(target=check_datanode_status, daemon=True)
-status_thread.start()
+    # Copia: register_datanode corre en el threadpool y puede añadir nodos
+    # mientras se recorre
+    for dn_url, info in list(datanode_status.items()):
+        if info["status"] == "active" and current_time - info["last_heartbeat"] > HEARTBEAT_TIMEOUT:
+            info["status"] = "inactive"
+            active_dn.discard(dn_url)
+            # register_datanode puede haber sustituido la entrada (y hecho su
+            # add) mientras tanto: se relee tras el discard y, si el heartbeat
+            # ya no está vencido, el nodo vuelve a active_dn
+            current = datanode_status.get(dn_url)
+            if current is not None and current["status"] == "active" and \
+                    current_time - current["last_heartbeat"] <= HEARTBEAT_TIMEOUT:
+                active_dn.add(dn_url)
+                continue
+            inactive_nodes.append(dn_url)
+
+    for node in inactive_nodes:
+        log_namenode(f"DataNode {node} marcado como inactivo", "WARNING")
+
+
+async def check_datanode_status():
+    """Periodically check DataNode status"""
+    while True:
+        await asyncio.sleep(HEARTBEAT_CHECK_INTERVAL)
+        # Un error en una pasada no debe detener la verificación para siempre
+        try:
+            sweep_inactive_datanodes()
+        except Exception as e:
+            log_namenode(f"Error verificando el estado de los DataNodes: {e}", "ERROR")
+
+
+def open_metadata_db() -> sqlite3.Connection:
+    """Abrir (o crear) la base de metadatos"""
+    db = sqlite3.connect(METADATA_DB, check_same_thread=False, isolation_level=None)
+    # Journal WAL de SQLite: un commit es un append, no una reescritura de páginas
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    for table in ("files", "directories"):
+        db.execute(f"CREATE TABLE IF NOT EXISTS {table} ("
+                   "user TEXT NOT NULL, path TEXT NOT NULL, meta BLOB NOT NULL, "
+                   "PRIMARY KEY (user, path)) WITHOUT ROWID")
+    # Las cuentas se guardan junto a los metadatos que poseen: sin ellas, tras
+    # un reinicio cualquiera podría registrar el nombre y leer sus archivos
+    db.execute("CREATE TABLE IF NOT EXISTS users ("
+               "username TEXT PRIMARY KEY, password_hash TEXT NOT NULL, "
+               "token_hash TEXT, token_created TEXT, created_at TEXT) WITHOUT ROWID")
+    return db
+
+
+@contextmanager
+def metadata_transaction():
+    """Transacción sobre la base de metadatos (un solo escritor a la vez)"""
+    with _db_lock:
+        _db.execute("BEGIN")
+        try:
+            yield _db
+        except BaseException:
+            _db.execute("ROLLBACK")
+            raise
+        _db.execute("COMMIT")
+
+
+# Tabla afectada por cada operación y si escribe o borra la fila
+_PERSIST_OPS = {
+    "put": ("files", True),
+    "del": ("files", False),
+    "mkdir": ("directories", True),
+    "rmdir": ("directories", False),
+}
+
+
+def persist_metadata(*changes: tuple):
+    """Guardar cambios (op, clave, meta) ya aplicados en memoria, en una sola transacción"""
+    with metadata_transaction() as db:
+        for op, (owner, path), *value in changes:
+            table, upsert = _PERSIST_OPS[op]
+            if upsert:
+                db.execute(f"INSERT OR REPLACE INTO {table} VALUES (?, ?, ?)",
+                           (owner, path, orjson.dumps(value[0])))
+            else:
+                db.execute(f"DELETE FROM {table} WHERE user = ? AND path = ?", (owner, path))
+
+
+def persist_users(*usernames: str):
+    """Guardar el registro actual de uno o más usuarios, en una sola transacción"""
+    with metadata_transaction() as db:
+        db.executemany("INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?)", [
+            (username, users[username]["password_hash"], users[username].get("token_hash"),
+             users[username].get("token_created"), users[username].get("created_at"))
+            for username in usernames
+        ])
+
+
+def load_metadata():
+    """Reconstruir users, files/directories y el árbol de rutas desde SQLite"""
+    for username, password_hash, token_hash, token_created, created_at in \
+            _db.execute("SELECT username, password_hash, token_hash, token_created, created_at FROM users"):
+        users[username] = {
+            "password_hash": password_hash,
+            "token_hash": token_hash,
+            "token_created": token_created,
+            "created_at": created_at
+        }
+        if token_hash:
+            token_hash_to_user[token_hash] = username
+    for owner, path, meta in _db.execute("SELECT user, path, meta FROM files"):
+        put_file((owner, path), orjson.loads(meta))
+    for owner, path, meta in _db.execute("SELECT user, path, meta FROM directories"):
+        put_directory((owner, path), orjson.loads(meta))
+    if users or files or directories:
+        log_namenode(f"Metadatos recuperados: {len(users)} usuarios, {len(files)} archivos, "
+                     f"{len(directories)} directorios")
+
+
+_db = open_metadata_db()
+load_metadata()
 
 
 class DataNodeRegistration(BaseModel):
@@ -94,6 +424,7 @@ class BlockInfo(BaseModel):
     index: int
     block_id: str
     datanode: str
+    encoding: Optional[str] = None
 
 
 class FileRegistration(BaseModel):
@@ -103,6 +434,20 @@ class FileRegistration(BaseModel):
     blocks: List[BlockInfo]
 
 
+class FileStreamHeader(BaseModel):
+    filename: str
+    size: int
+    block_size: int
+    total_blocks: int
+
+
+class UploadRequest(BaseModel):
+    filename: str
+    size: int
+    block_size: int
+    include_datanodes: bool = True
+
+
 class UserRegistration(BaseModel):
     username: str
     password: str
@@ -115,26 +460,49 @@ class HeartbeatData(BaseModel):
     storage_capacity: Optional[int] = 0
 
 
+def hash_token(token: str) -> str:
+    """Hash con el que se indexa y guarda un token de sesión"""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def hash_password(password: str, salt: Optional[str] = None) -> str:
+    """PBKDF2-SHA256 con sal aleatoria, como "sal$hash" en hexadecimal"""
+    salt = salt or secrets.token_hex(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), bytes.fromhex(salt), PASSWORD_HASH_ITERATIONS)
+    return f"{salt}${digest.hex()}"
+
+
+def verify_password(password: str, password_hash: str) -> bool:
+    salt = password_hash.split("$", 1)[0]
+    return secrets.compare_digest(hash_password(password, salt), password_hash)
+
+
 def get_current_user(token: str = Header(...)):
     """Obtener usuario actual basado en token"""
-    for username, data in users.items():
-        if data.get("token") == token:
-            return username
-    raise HTTPException(status_code=401, detail="Token inválido")
+    token_hash = hash_token(token)
+    username = token_hash_to_user.get(token_hash)
+    if username is None:
+        raise HTTPException(status_code=401, detail="Token inválido")
+    # Los tokens persisten entre reinicios: caducan TOKEN_EXPIRY_HOURS tras el login
+    token_created = users[username].get("token_created")
+    if not token_created or \
+            datetime.now() - datetime.fromisoformat(token_created) > timedelta(hours=TOKEN_EXPIRY_HOURS):
+        token_hash_to_user.pop(token_hash, None)
+        raise HTTPException(status_code=401, detail="Token expirado")
+    return username
 
 
 @app.get("/")
 def root():
     """Health check y estado del sistema"""
     active_datanodes = []
-    for dn_url, dn_info in datanodes.items():
-        if datanode_status.get(dn_url, {}).get("status") == "active":
-            active_datanodes.append({
-                "url": dn_url,
-                "node_id": dn_info["node_id"],
-                "last_heartbeat": datanode_status[dn_url]["last_heartbeat"].isoformat(),
-                "total_blocks": datanode_status[dn_url].get("total_blocks", 0)
-            })
+    for dn_url in list(active_dn):
+        active_datanodes.append({
+            "url": dn_url,
+            "node_id": datanodes[dn_url]["node_id"],
+            "last_heartbeat": datanode_status[dn_url]["last_heartbeat_at"],
+            "total_blocks": datanode_status[dn_url].get("total_blocks", 0)
+        })
 
     return {
         "status": "namenode_active",
@@ -143,15 +511,13 @@ def root():
         "total_files": len(files),
         "total_users": len(users),
         "total_directories": len(directories),
-        "timestamp": datetime.now().isoformat()
+        "timestamp": now_iso()
     }
 
 
 def get_active_datanodes() -> List[str]:
     """Obtener solo DataNodes activos"""
-    current_time = time.time()
-    return [dn_url for dn_url, status in datanode_status.items()
-            if status.get("last_heartbeat", 0) > current_time - HEARTBEAT_TIMEOUT]
+    return list(active_dn)
 
 
 def cleanup_expired_tokens():
@@ -159,14 +525,17 @@ def cleanup_expired_tokens():
     current_time = datetime.now()
     expired_users = []
     for username, user_data in users.items():
-        if "token_created" in user_data:
+        if user_data.get("token_created"):
             token_time = datetime.fromisoformat(user_data["token_created"])
             if current_time - token_time > timedelta(hours=TOKEN_EXPIRY_HOURS):
                 expired_users.append(username)
 
     for username in expired_users:
-        users[username]["token"] = None
+        token_hash_to_user.pop(users[username]["token_hash"], None)
+        users[username]["token_hash"] = None
         users[username]["token_created"] = None
+    if expired_users:
+        persist_users(*expired_users)
 
 
 @app.post("/register_datanode")
@@ -180,7 +549,7 @@ def register_datanode(registration: DataNodeRegistration):
             "url": datanode_url,
             "node_id": registration.node_id,
             "storage_capacity": registration.storage_capacity,
-            "registered_at": datetime.now().isoformat()
+            "registered_at": now_iso()
         }
         log_namenode(f"Nuevo DataNode registrado: {datanode_url} ({registration.node_id})")
     else:
@@ -193,66 +562,75 @@ def register_datanode(registration: DataNodeRegistration):
 
     # Marcar como activo
     datanode_status[datanode_url] = {
-        "last_heartbeat": datetime.now(),
+        "last_heartbeat": time.monotonic(),
+        "last_heartbeat_at": now_iso(),
         "status": "active",
         "total_blocks": 0,
         "storage_capacity": registration.storage_capacity
     }
+    active_dn.add(datanode_url)
 
     return {
         "status": "registered",
         "datanode": datanode_url,
         "node_id": registration.node_id,
-        "timestamp": datetime.now().isoformat()
+        "timestamp": now_iso()
     }
 
 
-@app.post("/heartbeat")
-def heartbeat(data: HeartbeatData):
+@app.post("/heartbeat", openapi_extra={"requestBody": {
+    "required": True,
+    "content": {"application/json": {"schema": HeartbeatData.model_json_schema()}}
+}})
+async def heartbeat(request: Request):
     """Procesar heartbeat de DataNode"""
+    # Llega de cada DataNode cada pocos segundos: se valida en una sola pasada
+    # sobre los bytes en lugar de json.loads + construcción del modelo
+    try:
+        data = HeartbeatData.model_validate_json(await request.body())
+    except ValidationError as e:
+        raise RequestValidationError([{**error, "loc": ("body", *error["loc"])}
+                                      for error in e.errors(include_url=False)])
     datanode_url = data.datanode_url
 
     if datanode_url in datanode_status:
         # Actualizar información del heartbeat
         datanode_status[datanode_url].update({
-            "last_heartbeat": datetime.now(),
+            "last_heartbeat": time.monotonic(),
+            "last_heartbeat_at": now_iso(),
             "status": "active",
             "total_blocks": data.total_blocks or 0,
             "storage_capacity": data.storage_capacity or 0
         })
+        active_dn.add(datanode_url)
     else:
         # Auto-registro si no existe
         datanodes[datanode_url] = {
             "url": datanode_url,
             "node_id": data.node_id or "unknown",
             "storage_capacity": data.storage_capacity or 0,
-            "registered_at": datetime.now().isoformat()
+            "registered_at": now_iso()
         }
         datanode_status[datanode_url] = {
-            "last_heartbeat": datetime.now(),
+            "last_heartbeat": time.monotonic(),
+            "last_heartbeat_at": now_iso(),
             "status": "active",
             "total_blocks": data.total_blocks or 0,
             "storage_capacity": data.storage_capacity or 0
         }
+        active_dn.add(datanode_url)
         log_namenode(f"DataNode auto-registrado vía heartbeat: {datanode_url}")
 
     return {
         "status": "acknowledged",
-        "timestamp": datetime.now().isoformat()
+        "timestamp": now_iso()
     }
 
 
 @app.get("/datanodes")
 def get_datanodes(username: str = Depends(get_current_user)):
     """Obtener lista de DataNodes activos"""
-    active_datanodes = []
-
-    for dn_url, dn_info in datanodes.items():
-        status_info = datanode_status.get(dn_url, {})
-        if status_info.get("status") == "active":
-            active_datanodes.append(dn_url)
-
-    return {"datanodes": active_datanodes}
+    return {"datanodes": list(active_dn)}
 
 
 @app.get("/datanodes/detailed")
@@ -260,17 +638,17 @@ def get_datanodes_detailed(username: str = Depends(get_current_user)):
     """Obtener información detallada de DataNodes activos"""
     detailed_nodes = []
 
-    for dn_url, dn_info in datanodes.items():
-        status_info = datanode_status.get(dn_url, {})
-        if status_info.get("status") == "active":
-            detailed_nodes.append({
-                "url": dn_url,
-                "node_id": dn_info["node_id"],
-                "storage_capacity": dn_info["storage_capacity"],
-                "total_blocks": status_info.get("total_blocks", 0),
-                "last_heartbeat": status_info["last_heartbeat"].isoformat(),
-                "registered_at": dn_info["registered_at"]
-            })
+    for dn_url in list(active_dn):
+        dn_info = datanodes[dn_url]
+        status_info = datanode_status[dn_url]
+        detailed_nodes.append({
+            "url": dn_url,
+            "node_id": dn_info["node_id"],
+            "storage_capacity": dn_info["storage_capacity"],
+            "total_blocks": status_info.get("total_blocks", 0),
+            "last_heartbeat": status_info["last_heartbeat_at"],
+            "registered_at": dn_info["registered_at"]
+        })
 
     return {"datanodes": detailed_nodes}
 
@@ -278,77 +656,193 @@ def get_datanodes_detailed(username: str = Depends(get_current_user)):
 @app.post("/register_file")
 def register_file(reg: FileRegistration, username: str = Depends(get_current_user)):
     """Registrar un nuevo archivo en el sistema"""
-    normalized_filename = f"/{reg.filename}" if not reg.filename.startswith("/") else reg.filename
-    normalized_filename = normalized_filename.replace("//", "/")
+    normalized_filename = normalize_path(reg.filename)
 
     # Verificar si el archivo ya existe
     key = (username, normalized_filename)
     if key in files:
         raise HTTPException(status_code=400, detail=f"File already exists: {normalized_filename}")
 
-    # Crear directorios padre automáticamente
+    # Validar que todos los bloques tienen DataNodes activos
+    invalid_blocks = [block.block_id for block in reg.blocks if block.datanode not in active_dn]
+
+    if invalid_blocks:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Some blocks reference inactive DataNodes: {invalid_blocks}"
+        )
+
+    # Registrar el archivo
+    store_file(username, normalized_filename, reg.size, reg.block_size, [b.model_dump() for b in reg.blocks])
+    return {
+        "msg": "Archivo registrado exitosamente",
+        "filename": normalized_filename,
+        "owner": username,
+        "blocks": len(reg.blocks),
+        "size": reg.size
+    }
+
+
+def store_file(username: str, normalized_filename: str, size: int, block_size: int, blocks: List[Dict]):
+    """Guardar los metadatos de un archivo, creando su directorio padre si falta"""
+    changes = []
     parent_dir = os.path.dirname(normalized_filename)
     if parent_dir != "/" and parent_dir:
         dir_key = (username, parent_dir)
         if dir_key not in directories:
-            directories[dir_key] = {
+            put_directory(dir_key, {
                 "type": "directory",
                 "owner": username,
-                "created_at": datetime.now().isoformat()
-            }
+                "created_at": now_iso()
+            })
+            changes.append(("mkdir", dir_key, directories[dir_key]))
             log_namenode(f"Auto-created directory: {parent_dir} for user: {username}")
 
-    # Validar que todos los bloques tienen DataNodes activos
+    # El cliente suele enviar los bloques ya ordenados: solo se ordena si hace falta
+    if any(blocks[i]["index"] > blocks[i + 1]["index"] for i in range(len(blocks) - 1)):
+        blocks = sorted(blocks, key=operator.itemgetter("index"))
+
+    key = (username, normalized_filename)
+    put_file(key, {
+        "size": size,
+        "block_size": block_size,
+        "blocks": blocks,
+        "created_at": now_iso(),
+        "owner": username
+    })
+    changes.append(("put", key, files[key]))
+    persist_metadata(*changes)
+    log_namenode(f"File registered: {normalized_filename} by {username} ({len(blocks)} blocks)")
+
+
+@app.post("/register_file_stream")
+async def register_file_stream(request: Request, username: str = Depends(get_current_user)):
+    """Registrar un archivo bloque a bloque (NDJSON: cabecera y luego una línea por bloque)"""
+    header = None
+    upload = None
+    key = None
+    already_exists = False
     invalid_blocks = []
-    for block in reg.blocks:
-        if block.datanode not in [dn for dn in datanodes.keys()
-                                  if datanode_status.get(dn, {}).get("status") == "active"]:
-            invalid_blocks.append(block.block_id)
 
+    def handle_line(line: bytes):
+        nonlocal header, upload, key, already_exists
+        if not line.strip():
+            return
+        if header is None:
+            try:
+                header = FileStreamHeader.model_validate_json(line)
+            except (ValueError, TypeError):
+                raise HTTPException(status_code=400, detail="Invalid stream header")
+            key = (username, normalize_path(header.filename))
+            already_exists = key in files
+            upload = pending_uploads.get(key)
+            # Una cabecera distinta a la de la subida pendiente la reinicia
+            if upload is None or (upload["size"], upload["block_size"], upload["total_blocks"]) != \
+                    (header.size, header.block_size, header.total_blocks):
+                upload = {
+                    "size": header.size,
+                    "block_size": header.block_size,
+                    "total_blocks": header.total_blocks,
+                    "blocks": {},
+                    "started_at": now_iso()
+                }
+            return
+        if already_exists:
+            return
+        try:
+            # Validación directa desde los bytes JSON (pydantic-core), sin dict intermedio
+            block = BlockInfo.model_validate_json(line)
+        except (ValueError, TypeError):
+            invalid_blocks.append(line.decode(errors="replace"))
+            return
+        if block.datanode not in active_dn or not 0 <= block.index < header.total_blocks:
+            invalid_blocks.append(block.block_id)
+            return
+        # Cada bloque queda confirmado en cuanto llega
+        upload["blocks"][block.index] = block.model_dump()
+        pending_uploads[key] = upload
+
+    # Leer todo el cuerpo aunque haya errores, para responder al final
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            handle_line(line)
+    handle_line(buffer)
+
+    if header is None:
+        raise HTTPException(status_code=400, detail="Missing stream header")
+    normalized_filename = key[1]
+    if already_exists:
+        raise HTTPException(status_code=400, detail=f"File already exists: {normalized_filename}")
     if invalid_blocks:
         raise HTTPException(
             status_code=400,
             detail=f"Some blocks reference inactive DataNodes: {invalid_blocks}"
         )
 
-    # Registrar el archivo
-    files[key] = {
-        "size": reg.size,
-        "block_size": reg.block_size,
-        "blocks": sorted([b.dict() for b in reg.blocks], key=lambda x: x["index"]),
-        "created_at": datetime.now().isoformat(),
-        "owner": username
-    }
+    committed = len(upload["blocks"])
+    if committed < header.total_blocks:
+        pending_uploads[key] = upload
+        log_namenode(f"Partial upload: {normalized_filename} by {username} ({committed}/{header.total_blocks} blocks)")
+        return {
+            "msg": "Registro parcial",
+            "filename": normalized_filename,
+            "complete": False,
+            "blocks": committed,
+            "total_blocks": header.total_blocks
+        }
 
-    log_namenode(f"File registered: {normalized_filename} by {username} ({len(reg.blocks)} blocks)")
+    pending_uploads.pop(key, None)
+    # Están todos los índices 0..total_blocks-1: se recorren en orden sin ordenar
+    blocks = upload["blocks"]
+    # store_file confirma una transacción en SQLite: fuera del event loop,
+    # como el register_file síncrono
+    await run_in_threadpool(store_file, username, normalized_filename, header.size, header.block_size,
+                            [blocks[i] for i in range(header.total_blocks)])
     return {
         "msg": "Archivo registrado exitosamente",
         "filename": normalized_filename,
         "owner": username,
-        "blocks": len(reg.blocks),
-        "size": reg.size
+        "complete": True,
+        "blocks": committed,
+        "size": header.size
+    }
+
+
+@app.get("/upload_status/{filename:path}")
+def upload_status(filename: str, username: str = Depends(get_current_user)):
+    """Bloques ya confirmados de una subida pendiente, para poder reanudarla"""
+    key = (username, normalize_path(filename))
+    upload = pending_uploads.get(key)
+
+    return {
+        "filename": key[1],
+        "exists": key in files,
+        "size": upload["size"] if upload else None,
+        "block_size": upload["block_size"] if upload else None,
+        "blocks": sorted(upload["blocks"].values(), key=operator.itemgetter("index")) if upload else []
     }
 
 
+@app.post("/begin_upload")
+def begin_upload(req: UploadRequest, username: str = Depends(get_current_user)):
+    """Preparar una subida en una sola petición: estado de la subida pendiente
+    (para reanudarla) y, si se piden, los DataNodes activos"""
+    status = upload_status(req.filename, username)
+    if req.include_datanodes:
+        status["datanodes"] = get_datanodes(username)["datanodes"]
+    return status
+
+
 @app.get("/file/{filename:path}")
 def get_file(filename: str, username: str = Depends(get_current_user)):
     """Obtener información de un archivo"""
-    normalized_filename = f"/{filename}" if not filename.startswith("/") else filename
-    normalized_filename = normalized_filename.replace("//", "/").rstrip("/")
+    normalized_filename = normalize_path(filename)
     key = (username, normalized_filename)
 
     if key not in files:
-        # Intentar formatos alternativos para compatibilidad
-        alternatives = [
-            (username, normalized_filename + "/"),
-            (username, normalized_filename.lstrip("/")),
-            (username, "/" + normalized_filename.lstrip("/"))
-        ]
-
-        for alt_key in alternatives:
-            if alt_key in files:
-                return files[alt_key]
-
         raise HTTPException(status_code=404, detail=f"File not found: {normalized_filename}")
 
     return files[key]
@@ -357,8 +851,7 @@ def get_file(filename: str, username: str = Depends(get_current_user)):
 @app.delete("/rm/{filename:path}")
 def rm(filename: str, username: str = Depends(get_current_user)):
     """Eliminar un archivo"""
-    normalized_filename = f"/{filename}" if not filename.startswith("/") else filename
-    normalized_filename = normalized_filename.replace("//", "/")
+    normalized_filename = normalize_path(filename)
     key = (username, normalized_filename)
 
     if key not in files:
@@ -369,7 +862,8 @@ def rm(filename: str, username: str = Depends(get_current_user)):
     blocks_info = file_info.get("blocks", [])
 
     # Eliminar el archivo de metadatos
-    del files[key]
+    delete_file(key)
+    persist_metadata(("del", key))
     log_namenode(f"File deleted: {normalized_filename} by {username}")
 
     return {
@@ -381,7 +875,9 @@ def rm(filename: str, username: str = Depends(get_current_user)):
 @app.post("/register")
 def register(user: UserRegistration):
     """Registrar nuevo usuario"""
-    if user.username in users:
+    # Un nombre con archivos o directorios persistidos pertenece a una cuenta
+    # existente aunque no esté en users: registrarlo daría acceso a sus datos
+    if user.username in users or user.username in user_roots:
         raise HTTPException(status_code=400, detail="Usuario ya existe")
 
     if len(user.username) < 3:
@@ -391,10 +887,11 @@ def register(user: UserRegistration):
         raise HTTPException(status_code=400, detail="Password debe tener al menos 6 caracteres")
 
     users[user.username] = {
-        "password": user.password,
-        "token": None,
-        "created_at": datetime.now().isoformat()
+        "password_hash": hash_password(user.password),
+        "token_hash": None,
+        "created_at": now_iso()
     }
+    persist_users(user.username)
 
     log_namenode(f"New user registered: {user.username}")
     return {"msg": "Usuario registrado exitosamente"}
@@ -403,12 +900,21 @@ def register(user: UserRegistration):
 @app.post("/login")
 def login(user: UserRegistration):
     """Iniciar sesión"""
-    if user.username not in users or users[user.username]["password"] != user.password:
+    if user.username not in users or not verify_password(user.password, users[user.username]["password_hash"]):
         raise HTTPException(status_code=401, detail="Credenciales inválidas")
 
-    token = secrets.token_hex(16)
-    users[user.username]["token"] = token
-    users[user.username]["last_login"] = datetime.now().isoformat()
+    # Misma entropía (128 bits) en 22 caracteres en lugar de 32
+    token = secrets.token_urlsafe(16)
+    token_hash = hash_token(token)
+    # El token anterior deja de ser válido
+    old_hash = users[user.username].get("token_hash")
+    if old_hash:
+        token_hash_to_user.pop(old_hash, None)
+    users[user.username]["token_hash"] = token_hash
+    users[user.username]["token_created"] = now_iso()
+    token_hash_to_user[token_hash] = user.username
+    users[user.username]["last_login"] = now_iso()
+    persist_users(user.username)
 
     log_namenode(f"User logged in: {user.username}")
     return {"token": token}
@@ -417,18 +923,18 @@ def login(user: UserRegistration):
 @app.post("/mkdir/{path:path}")
 def mkdir(path: str, username: str = Depends(get_current_user)):
     """Crear directorio"""
-    dir_path = f"/{path}" if not path.startswith("/") else path
-    dir_path = dir_path.replace("//", "/")
+    dir_path = normalize_path(path)
     key = (username, dir_path)
 
     if key in files or key in directories:
         raise HTTPException(status_code=400, detail=f"Path already exists: {dir_path}")
 
-    directories[key] = {
+    put_directory(key, {
         "type": "directory",
         "owner": username,
-        "created_at": datetime.now().isoformat()
-    }
+        "created_at": now_iso()
+    })
+    persist_metadata(("mkdir", key, directories[key]))
 
     log_namenode(f"Directory created: {dir_path} by {username}")
     return {"msg": f"Directory created: {dir_path}"}
@@ -437,20 +943,20 @@ def mkdir(path: str, username: str = Depends(get_current_user)):
 @app.delete("/rmdir/{path:path}")
 def rmdir(path: str, username: str = Depends(get_current_user)):
     """Eliminar directorio"""
-    dir_path = f"/{path}" if not path.startswith("/") else path
-    dir_path = dir_path.replace("//", "/")
+    dir_path = normalize_path(path)
     key = (username, dir_path)
 
     if key not in directories:
         raise HTTPException(status_code=404, detail=f"Directory not found: {dir_path}")
 
-    # Verificar que el directorio esté vacío
-    dir_prefix = dir_path.rstrip("/") + "/"
-    for (owner, item_path) in list(files.keys()) + list(directories.keys()):
-        if owner == username and item_path.startswith(dir_prefix) and item_path != dir_path:
+    # Verificar que el directorio esté vacío: el nodo no tiene hijos
+    with _paths_lock:
+        node = path_node(username, path_segments(dir_path))
+        if node is not None and (node.children or node.files):
             raise HTTPException(status_code=400, detail=f"Directory not empty: {dir_path}")
 
-    del directories[key]
+    delete_directory(key)
+    persist_metadata(("rmdir", key))
     log_namenode(f"Directory removed: {dir_path} by {username}")
     return {"msg": f"Directory removed: {dir_path}"}
 
@@ -458,36 +964,30 @@ def rmdir(path: str, username: str = Depends(get_current_user)):
 @app.get("/ls")
 def ls(path: str = "/", username: str = Depends(get_current_user)):
     """Listar contenido de directorio"""
-    if not path.startswith("/"):
-        path = "/" + path
-    path = path.replace("//", "/")
+    path = normalize_path(path)
 
     # Verificar que el directorio existe o es root
     if path != "/" and (username, path) not in directories:
         raise HTTPException(status_code=404, detail=f"Directory not found: {path}")
 
     items = []
-    path_prefix = path.rstrip("/") + "/" if path != "/" else "/"
-
-    # Añadir directorios
-    for (owner, dir_path), meta in directories.items():
-        if owner == username and dir_path.startswith(path_prefix) and dir_path != path:
-            relative_path = dir_path[len(path_prefix):].rstrip("/")
-            if "/" not in relative_path and relative_path:  # Solo hijos inmediatos
+    with _paths_lock:
+        node = path_node(username, path_segments(path))
+        if node is not None:
+            # Añadir directorios (solo hijos inmediatos creados)
+            for name, child in node.children.items():
+                if child.meta is not None:
+                    items.append({
+                        "name": name,
+                        "type": "directory",
+                        "size": 0,
+                        "created_at": child.meta.get("created_at", "")
+                    })
+
+            # Añadir archivos
+            for name, meta in node.files.items():
                 items.append({
-                    "name": relative_path,
-                    "type": "directory",
-                    "size": 0,
-                    "created_at": meta.get("created_at", "")
-                })
-
-    # Añadir archivos
-    for (owner, file_path), meta in files.items():
-        if owner == username and file_path.startswith(path_prefix):
-            relative_path = file_path[len(path_prefix):]
-            if "/" not in relative_path and relative_path:  # Solo hijos inmediatos
-                items.append({
-                    "name": relative_path,
+                    "name": name,
                     "type": "file",
                     "size": meta["size"],
                     "block_size": meta["block_size"],
@@ -498,25 +998,24 @@ def ls(path: str = "/", username: str = Depends(get_current_user)):
     return {"path": path, "items": items}
 
 
-async def verify_block_exists(block_info: Dict) -> bool:
-    """Verificar que un bloque existe en su DataNode"""
-    try:
-        if not all(key in block_info for key in ['datanode', 'block_id']):
-            return False
-
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
-            async with session.get(f"{block_info['datanode']}/block/{block_info['block_id']}") as response:
-                return response.status == 200
-    except Exception as e:
-        logger.error(f"Error verificando bloque {block_info.get('block_id', 'unknown')}: {e}")
-        return False
+async def fetch_stored_blocks(session: aiohttp.ClientSession, semaphore: asyncio.Semaphore,
+                              datanode: str, block_ids: List[str]) -> Dict[str, int]:
+    """Preguntar a un DataNode, en una sola petición, cuáles de los bloques tiene"""
+    async with semaphore:
+        try:
+            async with session.post(f"{datanode}/exists_batch", json={"block_ids": block_ids}) as response:
+                if response.status != 200:
+                    return {}
+                return (await response.json()).get("blocks", {})
+        except Exception as e:
+            logger.error(f"Error verificando bloques en {datanode}: {e}")
+            return {}
 
 
 @app.get("/file_health/{filename:path}")
 async def check_file_health(filename: str, username: str = Depends(get_current_user)):
     """Verificar integridad de un archivo"""
-    normalized_filename = f"/{filename}" if not filename.startswith("/") else filename
-    normalized_filename = normalized_filename.replace("//", "/").rstrip("/")
+    normalized_filename = normalize_path(filename)
     key = (username, normalized_filename)
 
     if key not in files:
@@ -525,44 +1024,60 @@ async def check_file_health(filename: str, username: str = Depends(get_current_u
     file_info = files[key]
     missing_blocks = []
 
-    # Verificar cada bloque asíncronamente
-    verification_tasks = [verify_block_exists(block) for block in file_info["blocks"]]
-    results = await asyncio.gather(*verification_tasks, return_exceptions=True)
-
-    for i, (block, result) in enumerate(zip(file_info["blocks"], results)):
-        if isinstance(result, Exception) or not result:
+    # Agrupar los bloques por DataNode: una consulta /exists_batch por cada
+    # HEALTH_CHECK_BATCH_SIZE bloques en lugar de descargar cada bloque
+    by_datanode: Dict[str, List[str]] = {}
+    for block in file_info["blocks"]:
+        if "datanode" in block and "block_id" in block:
+            by_datanode.setdefault(block["datanode"], []).append(block["block_id"])
+
+    semaphore = asyncio.Semaphore(HEALTH_CHECK_CONCURRENCY)
+    queries = [
+        (datanode, block_ids[start:start + HEALTH_CHECK_BATCH_SIZE])
+        for datanode, block_ids in by_datanode.items()
+        for start in range(0, len(block_ids), HEALTH_CHECK_BATCH_SIZE)
+    ]
+    results = await asyncio.gather(*(
+        fetch_stored_blocks(app.state.http, semaphore, datanode, block_ids)
+        for datanode, block_ids in queries
+    ))
+    stored = {(datanode, block_id) for (datanode, _), found in zip(queries, results) for block_id in found}
+
+    for i, block in enumerate(file_info["blocks"]):
+        if (block.get("datanode"), block.get("block_id")) not in stored:
             missing_blocks.append({
                 "index": i,
-                "block_id": block["block_id"],
-                "datanode": block["datanode"]
+                "block_id": block.get("block_id"),
+                "datanode": block.get("datanode")
             })
 
+    total_blocks = len(file_info["blocks"])
+
     return {
         "filename": normalized_filename,
-        "total_blocks": len(file_info["blocks"]),
+        "total_blocks": total_blocks,
         "missing_blocks": missing_blocks,
         "healthy": len(missing_blocks) == 0,
-        "integrity_score": (len(file_info["blocks"]) - len(missing_blocks)) / len(file_info["blocks"]) * 100
+        "integrity_score": (total_blocks - len(missing_blocks)) / total_blocks * 100 if total_blocks else 100.0
     }
 
 
 @app.get("/system_status")
 def get_system_status(username: str = Depends(get_current_user)):
     """Obtener estado completo del sistema"""
-    active_nodes = sum(1 for status in datanode_status.values() if status.get("status") == "active")
+    active_nodes = len(active_dn)
     inactive_nodes = len(datanode_status) - active_nodes
 
-    total_blocks = sum(status.get("total_blocks", 0) for status in datanode_status.values()
-                       if status.get("status") == "active")
+    total_blocks = sum(datanode_status[dn_url].get("total_blocks", 0) for dn_url in list(active_dn))
 
-    user_files = len([f for f in files.keys() if f[0] == username])
-    user_dirs = len([d for d in directories.keys() if d[0] == username])
+    user_files = len(user_files_index.get(username, ()))
+    user_dirs = len(user_dirs_index.get(username, ()))
 
     return {
         "system": {
             "status": "healthy",
             "uptime": "running",  # En producción calcularía el uptime real
-            "timestamp": datetime.now().isoformat()
+            "timestamp": now_iso()
         },
         "datanodes": {
             "total": len(datanodes),
@@ -591,5 +1106,6 @@ def get_distribution_plan(num_blocks: int, username: str = Depends(get_current_u
     if not active_nodes:
         raise HTTPException(status_code=503, detail="No hay DataNodes activos")
 
-    distribution = [active_nodes[i % len(active_nodes)] for i in range(num_blocks)]
+    # Round-robin construido en C, sin un módulo por bloque
+    distribution = list(islice(cycle(active_nodes), num_blocks))
     return {"distribution": distribution, "block_count": num_blocks}
\ No newline at end of file